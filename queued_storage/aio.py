@@ -0,0 +1,132 @@
+"""
+Async counterparts of the :class:`~queued_storage.backends.QueuedStorage`
+API for use in async (ASGI) views, e.g.:
+
+.. code-block:: python
+
+    async def avatar(request, name):
+        if not await storage.aexists(name):
+            raise Http404
+        return HttpResponseRedirect(await storage.aurl(name))
+
+Cache operations use the async cache API where available (Django 4.0+).
+Storage backend operations and task dispatching are blocking and run in
+the thread pool shared by all storages of the process (see
+:func:`~queued_storage.utils.get_executor`).
+
+Requires Python 3.5 or newer.
+"""
+import asyncio
+import functools
+
+from django.core.cache import cache
+
+from .utils import get_executor
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """
+    Runs the given blocking function in the shared thread pool.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def cache_get(key):
+    if hasattr(cache, 'aget'):
+        return await cache.aget(key)
+    return await run_in_executor(cache.get, key)
+
+
+async def cache_set(key, value):
+    if hasattr(cache, 'aset'):
+        return await cache.aset(key, value)
+    return await run_in_executor(cache.set, key, value)
+
+
+class AsyncStorageMixin(object):
+    """
+    A mixin for :class:`~queued_storage.backends.QueuedStorage` adding
+    async versions of its methods.
+    """
+    async def aresolve(self, name):
+        """
+        Async version of
+        :meth:`~queued_storage.backends.QueuedStorage.resolve`.
+        """
+        cache_key = self.get_cache_key(name)
+        cache_result = await cache_get(cache_key)
+        if cache_result is None:
+            cache_result = await run_in_executor(self._locate, name)
+            if cache_result:
+                await cache_set(cache_key, cache_result)
+        if self.prefer_local or self.read_through:
+            # checks the local storage
+            return await run_in_executor(self._resolve, name, cache_result)
+        return self._resolve(name, cache_result)
+
+    async def aget_storage(self, name):
+        """
+        Async version of
+        :meth:`~queued_storage.backends.QueuedStorage.get_storage`.
+        """
+        storage, stored_name = await self.aresolve(name)
+        return storage
+
+    async def aopen(self, name, mode='rb'):
+        """
+        Async version of
+        :meth:`~queued_storage.backends.QueuedStorage.open`.
+        """
+        storage, stored_name = await self.aresolve(name)
+        return await run_in_executor(self._open_resolved,
+                                     name, mode, storage, stored_name)
+
+    async def asave(self, name, content, max_length=None):
+        """
+        Async version of
+        :meth:`~queued_storage.backends.QueuedStorage.save`.
+        """
+        return await run_in_executor(self.save, name, content,
+                                     max_length=max_length)
+
+    async def aexists(self, name):
+        """
+        Async version of
+        :meth:`~queued_storage.backends.QueuedStorage.exists`.
+        """
+        storage, stored_name = await self.aresolve(name)
+        return await run_in_executor(storage.exists, stored_name)
+
+    async def aurl(self, name):
+        """
+        Async version of
+        :meth:`~queued_storage.backends.QueuedStorage.url`. URLs are
+        built without a thread hop, assuming storage backends don't do
+        any I/O for that.
+        """
+        storage, stored_name = await self.aresolve(name)
+        return storage.url(stored_name)
+
+    async def asize(self, name):
+        """
+        Async version of
+        :meth:`~queued_storage.backends.QueuedStorage.size`, using the
+        recorded metadata of the file as well.
+        """
+        return await run_in_executor(self.size, name)
+
+    async def adelete(self, name):
+        """
+        Async version of
+        :meth:`~queued_storage.backends.QueuedStorage.delete`.
+        """
+        return await run_in_executor(self.delete, name)
+
+    async def atransfer(self, name, cache_key=None):
+        """
+        Async version of
+        :meth:`~queued_storage.backends.QueuedStorage.transfer`.
+        """
+        return await run_in_executor(self.transfer, name, cache_key=cache_key)
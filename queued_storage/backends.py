@@ -1,3 +1,13 @@
+import hashlib
+import heapq
+import logging
+import posixpath
+import sys
+import threading
+import time
+import weakref
+from itertools import islice
+
 import six
 
 from packaging import version
@@ -6,59 +16,237 @@ import django
 
 from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
-from django.utils.functional import SimpleLazyObject
+from django.core.files.base import File
+from django.db import transaction
+from django.utils.encoding import force_bytes
+from django.utils.functional import SimpleLazyObject, empty
 from django.utils.http import urlquote
 
+from .compression import (ENCODINGS, decompress, get_compressed_name,
+                          get_content_encoding, get_original_name, locate)
 from .conf import settings
-from .utils import import_attribute
+from .dispatch import dispatch, dispatch_on_commit
+from .lru import touch
+from .profiling import note_backend, note_lookup, profiled
+from .utils import (Backlog, freeze, get_backend, get_backend_pool,
+                    get_executor, import_attribute)
 
 DJANGO_VERSION = django.get_version()
 
+logger = logging.getLogger(__name__)
+
 if version.parse(DJANGO_VERSION) <= version.parse('1.7'):
     from django.utils.deconstruct import deconstructible
 
+if sys.version_info >= (3, 5):
+    from .aio import AsyncStorageMixin
+else:  # pragma: no cover
+    AsyncStorageMixin = object
 
-class LazyBackend(SimpleLazyObject):
+#: The maximum length of the file name part of cache keys, longer names
+#: are hashed to stay below memcached's key length limit of 250.
+MAX_CACHE_KEY_NAME_LENGTH = 160
+
+#: The number of listed remote files to add the locations of to the cache
+#: at once, see :meth:`~queued_storage.backends.QueuedStorage.iter_listdir`.
+LISTDIR_LOCATE_BATCH_SIZE = 1000
+
+#: The name of the file whose existence is checked in the remote storages
+#: to open their connections, see :func:`~queued_storage.backends.warm_up`.
+WARM_UP_NAME = '.queued_storage_warm_up'
+
+# all queued storages of the process
+_storages = weakref.WeakSet()
+
+# memoized file name parts of cache keys
+_cache_key_names = {}
+_cache_key_names_size = 10000
+
+# memoized cache generations and their expiry, by cache prefix
+_cache_generations = {}
+
+
+def warm_up():
+    """
+    Creates the backends of all queued storages of the process and the
+    storages defined in
+    :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKENDS`, and opens
+    the connections of the remote ones by checking whether a file exists,
+    so that the first transfers don't have to. If
+    :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKEND_POOL_SIZE`
+    is set, an instance is created in the pool of each remote storage.
+
+    Called when a Celery worker process starts, see
+    :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_WARM_UP`.
+
+    :returns: the number of remote storages connected to
+    :rtype: int
+    """
+    backends = [LazyBackend(alias, None)
+                for alias in settings.QUEUED_STORAGE_BACKENDS]
+    remotes = {}
+    for storage in list(_storages):
+        backends.append(storage.local)
+        backends.extend(storage.remotes)
+        if len(storage.remotes) > 1:
+            remote_configs = zip(storage.remote_path, storage.remote_options)
+        else:
+            remote_configs = [(storage.remote_path, storage.remote_options)]
+        for path, options in remote_configs:
+            try:
+                remotes[path, freeze(options)] = (path, options)
+            except TypeError:
+                # unhashable options, see get_backend
+                remotes[path, id(options)] = (path, options)
+    for backend in backends:
+        try:
+            # accessing any attribute creates the lazy backend
+            backend.__class__
+        except Exception:
+            logger.exception("Unable to create a storage backend.")
+    connected = 0
+    for path, options in remotes.values():
+        try:
+            if settings.QUEUED_STORAGE_BACKEND_POOL_SIZE:
+                get_backend_pool(path, options).warm_up(_probe)
+            else:
+                _probe(get_backend(path, options))
+        except Exception:
+            logger.exception("Unable to connect to the remote storage '%s'.",
+                             path)
+        else:
+            connected += 1
+    return connected
 
+
+def _probe(backend):
+    backend.exists(WARM_UP_NAME)
+
+
+class LazyBackend(SimpleLazyObject):
+    """
+    A lazy storage backend instance. Neither the backend's module is imported
+    nor the backend is instantiated until the first attribute access. The
+    resulting instance is shared with other lazy backends using the same
+    import path and options.
+    """
     def __init__(self, import_path, options):
-        backend = import_attribute(import_path)
-        super(LazyBackend, self).__init__(lambda: backend(**options))
+        super(LazyBackend, self).__init__(
+            lambda: get_backend(import_path, options))
+
+
+class LazyTask(SimpleLazyObject):
+    """
+    A lazy task, only imported on first use (e.g. when queuing a transfer).
+    """
+    def __init__(self, import_path, options=None):
+        super(LazyTask, self).__init__(lambda: import_attribute(import_path))
+
+    def __call__(self, *args, **kwargs):
+        if self._wrapped is empty:
+            self._setup()
+        return self._wrapped(*args, **kwargs)
+
+
+#: The policies applied by :meth:`QueuedStorage.save` when the backlog of
+#: files waiting for their transfers is full, see
+#: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKLOG_POLICY`.
+BACKLOG_POLICIES = ('throttle', 'inline', 'reject')
+
+
+class BacklogFull(IOError):
+    """
+    Raised by :meth:`QueuedStorage.save` if the backlog of files waiting
+    for their transfers to the remote storage is full.
+    """
 
 
-class QueuedStorage(object):
+class QueuedStorage(AsyncStorageMixin):
     """
     Base class for queued storages. You can use this to specify your own
     backends.
 
-    :param local: local storage class to transfer from
+    :param local: local storage class or alias to transfer from
     :type local: str
     :param local_options: options of the local storage class
     :type local_options: dict
-    :param remote: remote storage class to transfer to
-    :type remote: str
-    :param remote_options: options of the remote storage class
-    :type remote_options: dict
+    :param remote: remote storage class or alias to transfer to, or a list
+                   of them to replicate files to
+    :type remote: str or list
+    :param remote_options: options of the remote storage class, or a list
+                           of them matching the list of remote storages
+    :type remote_options: dict or list
     :param cache_prefix: prefix to use in the cache key
     :type cache_prefix: str
     :param delayed: whether the transfer task should be executed automatically
     :type delayed: bool
     :param task: Celery task to use for the transfer
     :type task: str
+    :param prefer_local: whether to use local copies of transferred files
+    :type prefer_local: bool
+    :param read_through: whether to copy remote files to the local storage
+                         when opening them
+    :type read_through: bool
+    :param fetch_task: Celery task to use for copying remote files to the
+                       local storage
+    :type fetch_task: str
+    :param ignore_result: whether to queue transfers without tracking
+                          their results
+    :type ignore_result: bool
+    :param on_commit: whether to queue transfers when the current database
+                      transaction is committed
+    :type on_commit: bool
+    :param inline_max_size: the maximum size in bytes of files to upload
+                            right away when saving them
+    :type inline_max_size: int
+    :param inline_timeout: the number of seconds to wait for uploads of
+                           small files before queuing their transfers
+    :type inline_timeout: float
+    :param max_backlog_files: the maximum number of files waiting for their
+                              transfers
+    :type max_backlog_files: int
+    :param max_backlog_bytes: the maximum total size in bytes of the files
+                              waiting for their transfers
+    :type max_backlog_bytes: int
+    :param backlog_policy: what to do with files saved while the backlog is
+                           full, ``'throttle'``, ``'inline'`` or
+                           ``'reject'``
+    :type backlog_policy: str
+    :param backlog_throttle_timeout: the number of seconds to wait for the
+                                     backlog to drain with the
+                                     ``'throttle'`` policy
+    :type backlog_throttle_timeout: float
+    :param queued_delete: whether to delete files from the remote storage
+                          in a task
+    :type queued_delete: bool
+    :param delete_task: Celery task to use for deleting files from the
+                        remote storage
+    :type delete_task: str
     """
     #: The local storage class to use. A dotted path (e.g.
-    #: ``'django.core.files.storage.FileSystemStorage'``).
+    #: ``'django.core.files.storage.FileSystemStorage'``) or the alias of
+    #: a storage defined in the
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKENDS` setting.
     local = None
 
     #: The options of the local storage class, defined as a dictionary.
     local_options = None
 
     #: The remote storage class to use. A dotted path (e.g.
-    #: ``'django.core.files.storage.FileSystemStorage'``).
+    #: ``'django.core.files.storage.FileSystemStorage'``) or the alias of
+    #: a storage defined in the
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKENDS` setting.
     remote = None
 
     #: The options of the remote storage class, defined as a dictionary.
     remote_options = None
 
+    #: The remote storage backend instances, a list with the remote storage
+    #: as the only item unless multiple remote storages are given. Files are
+    #: transferred to all of them, and read from the first one of them
+    #: (i.e. the nearest) they exist in.
+    remotes = None
+
     #: The Celery task class to use to transfer files from the local
     #: to the remote storage. A dotted path (e.g.
     #: ``'queued_storage.tasks.Transfer'``).
@@ -70,6 +258,86 @@ class QueuedStorage(object):
     #: method.
     delayed = False
 
+    #: If set to ``True`` transfers are queued without storing their results
+    #: in the Celery result backend, and
+    #: :meth:`~queued_storage.backends.QueuedStorage.save` doesn't keep them
+    #: in :attr:`~queued_storage.backends.QueuedStorage.result`.
+    ignore_result = False
+
+    #: If set to ``True`` transfers of files saved during a database
+    #: transaction are queued when the transaction is committed, all at
+    #: once, and dropped if it's rolled back (see
+    #: :func:`~queued_storage.dispatch.dispatch_on_commit`), including the
+    #: ones which would be uploaded right away otherwise (see
+    #: :meth:`~queued_storage.backends.QueuedStorage.transfer_inline`).
+    #: In that case :meth:`~queued_storage.backends.QueuedStorage.save`
+    #: doesn't keep the results in
+    #: :attr:`~queued_storage.backends.QueuedStorage.result`.
+    #: Requires Django 1.9 or newer.
+    on_commit = False
+
+    #: The maximum size in bytes of files which are uploaded to the remote
+    #: storage right away when saving them, instead of queuing their
+    #: transfers, ``None`` to always queue them (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_INLINE_MAX_SIZE`)
+    inline_max_size = settings.QUEUED_STORAGE_INLINE_MAX_SIZE
+
+    #: The number of seconds to wait for the upload of a small file before
+    #: queuing its transfer instead (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_INLINE_TIMEOUT`)
+    inline_timeout = settings.QUEUED_STORAGE_INLINE_TIMEOUT
+
+    #: The maximum number of files saved to the local storage which wait
+    #: for their transfers, ``None`` for no limit (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKLOG_MAX_FILES`)
+    max_backlog_files = settings.QUEUED_STORAGE_BACKLOG_MAX_FILES
+
+    #: The maximum total size in bytes of the files saved to the local
+    #: storage which wait for their transfers, ``None`` for no limit
+    #: (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKLOG_MAX_BYTES`)
+    max_backlog_bytes = settings.QUEUED_STORAGE_BACKLOG_MAX_BYTES
+
+    #: What :meth:`~queued_storage.backends.QueuedStorage.save` does with
+    #: files which don't fit into the backlog, see
+    #: :meth:`~queued_storage.backends.QueuedStorage.admit` (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKLOG_POLICY`)
+    backlog_policy = settings.QUEUED_STORAGE_BACKLOG_POLICY
+
+    #: The number of seconds to wait for the backlog to drain with the
+    #: ``'throttle'`` policy (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKLOG_THROTTLE_TIMEOUT`)
+    backlog_throttle_timeout = settings.QUEUED_STORAGE_BACKLOG_THROTTLE_TIMEOUT
+
+    #: If set to ``True`` the local copy of a file is used as long as it
+    #: exists, even after the file was transferred to the remote storage.
+    #: Use this together with the
+    #: :class:`~queued_storage.tasks.TransferAndCache` task to keep the
+    #: most recently used files on the local storage.
+    prefer_local = False
+
+    #: If set to ``True`` opening a file which only exists in the remote
+    #: storage queues the :attr:`~queued_storage.backends.QueuedStorage.fetch_task`
+    #: to copy it to the local storage, which is used from then on (like
+    #: with :attr:`~queued_storage.backends.QueuedStorage.prefer_local`).
+    read_through = False
+
+    #: The Celery task class to use to copy files from the remote to the
+    #: local storage. A dotted path (e.g. ``'queued_storage.tasks.Fetch'``).
+    fetch_task = 'queued_storage.tasks.Fetch'
+
+    #: If set to ``True``
+    #: :meth:`~queued_storage.backends.QueuedStorage.delete` deletes the
+    #: local copy of a file and queues the
+    #: :attr:`~queued_storage.backends.QueuedStorage.delete_task` to delete
+    #: it from the remote storage, see
+    #: :meth:`~queued_storage.backends.QueuedStorage.delete_many`.
+    queued_delete = False
+
+    #: The Celery task class to use to delete files from the remote
+    #: storage. A dotted path (e.g. ``'queued_storage.tasks.Delete'``).
+    delete_task = 'queued_storage.tasks.Delete'
+
     #: The cache key prefix to use when saving the which storage backend
     #: to use, local or remote (default see
     #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_CACHE_PREFIX`)
@@ -77,7 +345,13 @@ class QueuedStorage(object):
 
     def __init__(self, local=None, remote=None,
                  local_options=None, remote_options=None,
-                 cache_prefix=None, delayed=None, task=None):
+                 cache_prefix=None, delayed=None, task=None,
+                 prefer_local=None, read_through=None, fetch_task=None,
+                 ignore_result=None, on_commit=None, inline_max_size=None,
+                 inline_timeout=None, max_backlog_files=None,
+                 max_backlog_bytes=None, backlog_policy=None,
+                 backlog_throttle_timeout=None, queued_delete=None,
+                 delete_task=None):
 
         self.local_path = local or self.local
         self.local_options = local_options or self.local_options or {}
@@ -86,15 +360,79 @@ class QueuedStorage(object):
 
         self.remote_path = remote or self.remote
         self.remote_options = remote_options or self.remote_options or {}
-        self.remote = self._load_backend(backend=self.remote_path,
-                                         options=self.remote_options)
+        if isinstance(self.remote_path, (list, tuple)):
+            self.remote_path = list(self.remote_path)
+            if not self.remote_options:
+                self.remote_options = [{} for path in self.remote_path]
+            if len(self.remote_options) != len(self.remote_path):
+                raise ImproperlyConfigured("The QueuedStorage class '%s' "
+                                           "requires a list of options for "
+                                           "each of its remote backends." %
+                                           self)
+            self.remotes = [self._load_backend(backend=path, options=options)
+                            for path, options in zip(self.remote_path,
+                                                     self.remote_options)]
+        else:
+            self.remotes = [self._load_backend(backend=self.remote_path,
+                                               options=self.remote_options)]
+        self.remote = self.remotes[0]
 
         self.task = self._load_backend(backend=task or self.task,
-                                       handler=import_attribute)
+                                       handler=LazyTask)
+        self.fetch_task = self._load_backend(
+            backend=fetch_task or self.fetch_task, handler=LazyTask)
+        self.delete_task = self._load_backend(
+            backend=delete_task or self.delete_task, handler=LazyTask)
         if delayed is not None:
             self.delayed = delayed
         if cache_prefix is not None:
             self.cache_prefix = cache_prefix
+        if prefer_local is not None:
+            self.prefer_local = prefer_local
+        if read_through is not None:
+            self.read_through = read_through
+        if ignore_result is not None:
+            self.ignore_result = ignore_result
+        if on_commit is not None:
+            self.on_commit = on_commit
+        if self.on_commit and not hasattr(transaction, 'on_commit'):
+            raise ImproperlyConfigured("The on_commit option requires "
+                                       "Django 1.9 or newer.")
+        if inline_max_size is not None:
+            self.inline_max_size = inline_max_size
+        if inline_timeout is not None:
+            self.inline_timeout = inline_timeout
+        if max_backlog_files is not None:
+            self.max_backlog_files = max_backlog_files
+        if max_backlog_bytes is not None:
+            self.max_backlog_bytes = max_backlog_bytes
+        if backlog_policy is not None:
+            self.backlog_policy = backlog_policy
+        if backlog_throttle_timeout is not None:
+            self.backlog_throttle_timeout = backlog_throttle_timeout
+        if queued_delete is not None:
+            self.queued_delete = queued_delete
+        if self.backlog_policy not in BACKLOG_POLICIES:
+            raise ImproperlyConfigured("The QueuedStorage class '%s' "
+                                       "doesn't support the backlog policy "
+                                       "'%s', use one of %s." %
+                                       (self, self.backlog_policy,
+                                        ', '.join(BACKLOG_POLICIES)))
+        self._thread_state = threading.local()
+        _storages.add(self)
+
+    @property
+    def result(self):
+        """
+        The result of the last transfer queued by
+        :meth:`~queued_storage.backends.QueuedStorage.save` in the current
+        thread, or ``None``.
+        """
+        return getattr(self._thread_state, 'result', None)
+
+    @result.setter
+    def result(self, result):
+        self._thread_state.result = result
 
     def _load_backend(self, backend=None, options=None, handler=LazyBackend):
         if backend is None:  # pragma: no cover
@@ -108,6 +446,7 @@ class QueuedStorage(object):
                                        "not instances or classes" % self)
         return handler(backend, options)
 
+    @profiled
     def get_storage(self, name):
         """
         Returns the storage backend instance responsible for the file
@@ -118,25 +457,147 @@ class QueuedStorage(object):
         :type name: str
         :rtype: :class:`~django:django.core.files.storage.Storage`
         """
-        cache_result = cache.get(self.get_cache_key(name))
-        if cache_result:
-            return self.remote
-        elif cache_result is None and self.remote.exists(name):
-            cache.set(self.get_cache_key(name), True)
-            return self.remote
+        return self.resolve(name)[0]
+
+    @profiled
+    def resolve(self, name, location=None):
+        """
+        Returns the storage backend instance responsible for the file with
+        the given name (like
+        :meth:`~queued_storage.backends.QueuedStorage.get_storage`) and the
+        name of the file in that storage, which differs from the given
+        name for files compressed when transferred to the remote storage.
+
+        :param name: file name
+        :type name: str
+        :param location: the location of the file if known, as cached
+                         after its transfer (``True`` or the content
+                         encoding it's compressed with), to skip the
+                         cache lookup
+        :rtype: tuple
+        """
+        if location:
+            return self._resolve(name, location)
+        cache_key = self.get_cache_key(name)
+        cache_result = cache.get(cache_key)
+        note_lookup(cache_result is not None)
+        if cache_result is None:
+            cache_result = self._locate(name)
+            if cache_result:
+                cache.set(cache_key, cache_result)
+        return self._resolve(name, cache_result)
+
+    def _resolve(self, name, cache_result):
+        if isinstance(cache_result, tuple):
+            # the location in each of multiple remote storages
+            remotes = [(remote, state) for remote, state
+                       in zip(self.remotes, cache_result) if state]
+        elif cache_result:
+            remotes = [(self.remote, cache_result)]
         else:
-            return self.local
+            remotes = []
+        prefer_local = self.prefer_local or self.read_through
+        if remotes and not (prefer_local and touch(self.local, name)):
+            remote, state = remotes[0]
+            note_backend(self, remote)
+            if isinstance(state, six.string_types):
+                return remote, get_compressed_name(name, state)
+            return remote, name
+        note_backend(self, self.local)
+        return self.local, name
+
+    def _get_compression(self):
+        # the content encoding of the transfer task, or the configured one
+        # for tasks which don't compress files themselves
+        return (getattr(self.task, 'compression', None) or
+                settings.QUEUED_STORAGE_COMPRESSION)
+
+    def _locate(self, name):
+        encoding = self._get_compression()
+        if len(self.remotes) == 1:
+            return locate(self.remote, name, encoding)
+        states = []
+        for remote in self.remotes:
+            states.append(locate(remote, name, encoding))
+            if states[-1]:
+                # no need to look any further
+                states.extend([None] * (len(self.remotes) - len(states)))
+                return tuple(states)
+        return False
 
     def get_cache_key(self, name):
         """
-        Returns the cache key for the given file name.
+        Returns the cache key for the given file name, made of the cache
+        prefix, the current cache generation (see
+        :meth:`~queued_storage.backends.QueuedStorage.invalidate_cache`)
+        and the quoted file name, or a hash of it for long names.
 
         :param name: file name
         :type name: str
         :rtype: str
         """
-        return '%s_%s' % (self.cache_prefix, urlquote(name))
+        try:
+            key_name = _cache_key_names[name]
+        except KeyError:
+            key_name = urlquote(name)
+            if len(key_name) > MAX_CACHE_KEY_NAME_LENGTH:
+                key_name = hashlib.md5(force_bytes(name)).hexdigest()
+            if len(_cache_key_names) >= _cache_key_names_size:
+                _cache_key_names.clear()
+            _cache_key_names[name] = key_name
+        return '%s_%s_%s' % (self.cache_prefix,
+                             self.get_cache_generation(), key_name)
+
+    def get_cache_generation(self):
+        """
+        Returns the current generation of the cache keys with the storage's
+        cache prefix. It's looked up in the cache at most once every
+        :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_CACHE_GENERATION_TTL`
+        seconds per process.
+
+        :rtype: int
+        """
+        now = time.time()
+        generation, expires = _cache_generations.get(self.cache_prefix,
+                                                     (None, 0))
+        if expires <= now:
+            generation_key = '%s_generation' % self.cache_prefix
+            generation = cache.get(generation_key)
+            if generation is None:
+                # start with the current time to not reuse old generations
+                generation = int(now)
+                if not cache.add(generation_key, generation, None):
+                    generation = cache.get(generation_key, generation)
+            _cache_generations[self.cache_prefix] = (
+                generation, now + settings.QUEUED_STORAGE_CACHE_GENERATION_TTL)
+        return generation
+
+    def invalidate_cache(self):
+        """
+        Invalidates all cached file locations of storages with the same
+        cache prefix at once, by incrementing the cache generation. Other
+        processes pick up the new generation within
+        :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_CACHE_GENERATION_TTL`
+        seconds.
 
+        :returns: the new cache generation
+        :rtype: int
+        """
+        generation_key = '%s_generation' % self.cache_prefix
+        try:
+            generation = cache.incr(generation_key)
+        except ValueError:
+            # the generation got lost, make sure to not reuse the last one
+            last_generation = _cache_generations.get(self.cache_prefix,
+                                                     (0, 0))[0]
+            generation = max(int(time.time()), last_generation + 1)
+            cache.set(generation_key, generation, None)
+        _cache_generations[self.cache_prefix] = (
+            generation,
+            time.time() + settings.QUEUED_STORAGE_CACHE_GENERATION_TTL)
+        return generation
+
+    @profiled
     def using_local(self, name):
         """
         Determines for the file with the given name whether
@@ -148,6 +609,7 @@ class QueuedStorage(object):
         """
         return self.get_storage(name) is self.local
 
+    @profiled
     def using_remote(self, name):
         """
         Determines for the file with the given name whether
@@ -157,8 +619,9 @@ class QueuedStorage(object):
         :type name: str
         :rtype: bool
         """
-        return self.get_storage(name) is self.remote
+        return self.get_storage(name) is not self.local
 
+    @profiled
     def open(self, name, mode='rb'):
         """
         Retrieves the specified file from storage.
@@ -169,40 +632,211 @@ class QueuedStorage(object):
         :type mode: str
         :rtype: :class:`~django:django.core.files.File`
         """
-        return self.get_storage(name).open(name, mode)
-
+        storage, stored_name = self.resolve(name)
+        return self._open_resolved(name, mode, storage, stored_name)
+
+    def _open_resolved(self, name, mode, storage, stored_name):
+        reading = 'r' in mode and '+' not in mode
+        if self.read_through and storage is not self.local and reading:
+            self.fetch(name)
+        if stored_name != name and reading:
+            encoding = get_content_encoding(name, stored_name)
+            return File(decompress(storage.open(stored_name, 'rb'), encoding),
+                        name=name)
+        return storage.open(stored_name, mode)
+
+    @profiled
     def save(self, name, content, max_length=None):
         """
         Saves the given content with the given name using the local
         storage. If the :attr:`~queued_storage.backends.QueuedStorage.delayed`
         attribute is ``True`` this will automatically call the
         :meth:`~queued_storage.backends.QueuedStorage.transfer` method
-        queuing the transfer from local to remote storage.
+        queuing the transfer from local to remote storage, unless the file
+        is small enough to be uploaded right away (see
+        :meth:`~queued_storage.backends.QueuedStorage.transfer_inline`).
+
+        If the backlog of files waiting for their transfers is limited, the
+        file is only saved if it fits, see
+        :meth:`~queued_storage.backends.QueuedStorage.admit`.
 
         :param name: file name
         :type name: str
         :param content: content of the file specified by name
         :type content: :class:`~django:django.core.files.File`
         :rtype: str
+        :raises: :class:`~queued_storage.backends.BacklogFull`
         """
-        cache_key = self.get_cache_key(name)
-        cache.set(cache_key, False)
+        limited = (self.max_backlog_files is not None or
+                   self.max_backlog_bytes is not None)
+        force_inline = limited and self.admit(content.size)
 
         # Use a name that is available on both the local and remote storage
         # systems and save locally.
-        name = self.get_available_name(name)
         try:
-            name = self.local.save(name, content, max_length=max_length)
-        except TypeError:
-            # Django < 1.10
-            name = self.local.save(name, content)
+            name = self.get_available_name(name)
+            try:
+                name = self.local.save(name, content, max_length=max_length)
+            except TypeError:
+                # Django < 1.10
+                name = self.local.save(name, content)
+        except Exception:
+            if limited:
+                Backlog(self.local).release(content.size)
+            raise
+        # the cache key of the name the file was saved with in the end
+        cache_key = self.get_cache_key(name)
+        cache.set(cache_key, False)
+        if self.queued_delete:
+            # saved again, so a pending delete task must leave it alone
+            cache.delete('%s_deleted' % cache_key)
+        if limited:
+            Backlog(self.local).add(cache_key, content.size, reserved=True)
 
         # Pass on the cache key to prevent duplicate cache key creation,
         # we save the result in the storage to be able to test for it
         if not self.delayed:
-            self.result = self.transfer(name, cache_key=cache_key)
+            # files saved in a transaction aren't uploaded before it's
+            # committed, see on_commit
+            deferred = (self.on_commit and
+                        transaction.get_connection().in_atomic_block)
+            if not deferred and self.transfer_inline(name,
+                                                     force=force_inline):
+                self.result = None
+            elif self.on_commit:
+                dispatch_on_commit(self.get_transfer_call(name, cache_key))
+            else:
+                result = self.transfer(name, cache_key=cache_key)
+                if not self.ignore_result:
+                    self.result = result
         return name
 
+    def get_backlog(self):
+        """
+        Returns the number of files saved to the local storage which wait
+        for their transfers, and their total size in bytes. Only files saved
+        while the backlog is limited (see
+        :attr:`~queued_storage.backends.QueuedStorage.max_backlog_files` and
+        :attr:`~queued_storage.backends.QueuedStorage.max_backlog_bytes`)
+        are counted.
+
+        :rtype: tuple
+        """
+        return Backlog(self.local).get()
+
+    def admit(self, size):
+        """
+        Reserves a place for a file of the given size in the backlog of
+        files waiting for their transfers (see
+        :meth:`~queued_storage.utils.Backlog.reserve`) if it fits, and
+        applies the
+        :attr:`~queued_storage.backends.QueuedStorage.backlog_policy`
+        otherwise:
+
+        ``'throttle'``
+            Waits up to
+            :attr:`~queued_storage.backends.QueuedStorage.backlog_throttle_timeout`
+            seconds for the backlog to drain, slowing down the uploads to
+            the pace of the transfers, then rejects the file.
+
+        ``'inline'``
+            Uploads the file to the remote storage while saving it, waiting
+            for the upload without a timeout, if it's not larger than
+            :attr:`~queued_storage.backends.QueuedStorage.inline_max_size`
+            (if set). Rejects larger files and files of delayed storages.
+
+        ``'reject'``
+            Rejects the file.
+
+        :param size: the size of the file in bytes
+        :type size: int
+        :returns: whether to upload the file while saving it
+        :rtype: bool
+        :raises: :class:`~queued_storage.backends.BacklogFull` if the file
+                 is rejected
+        """
+        backlog = Backlog(self.local)
+        deadline = time.time() + self.backlog_throttle_timeout
+        while True:
+            if backlog.reserve(size, self.max_backlog_files,
+                               self.max_backlog_bytes):
+                return False
+            if self.backlog_policy == 'throttle':
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    time.sleep(min(remaining, 0.1))
+                    continue
+            elif (self.backlog_policy == 'inline' and not self.delayed and
+                    (self.inline_max_size is None or
+                     size <= self.inline_max_size)):
+                # counted until the upload removes it from the backlog
+                backlog.reserve(size)
+                return True
+            files, total = backlog.get()
+            raise BacklogFull("The backlog of '%s' is full with %d files "
+                              "(%d bytes) waiting for their transfers." %
+                              (self, files, total))
+
+    def transfer_inline(self, name, force=False):
+        """
+        Uploads the file with the given name to the remote storage right
+        away if it's not larger than
+        :attr:`~queued_storage.backends.QueuedStorage.inline_max_size`,
+        waiting at most
+        :attr:`~queued_storage.backends.QueuedStorage.inline_timeout`
+        seconds for the upload to finish. The file is uploaded by running
+        the transfer task once in a thread of the shared pool (see
+        :meth:`~queued_storage.tasks.Transfer.attempt`), with the same
+        compression, lease and clean-up as a queued transfer.
+
+        :param name: file name
+        :type name: str
+        :param force: whether to upload the file regardless of its size and
+                      wait for the upload without a timeout
+        :type force: bool
+        :returns: whether the file was uploaded, otherwise its transfer
+                  needs to be queued
+        :rtype: bool
+        """
+        if self.inline_max_size is None and not force:
+            return False
+        try:
+            if not force and self.local.size(name) > self.inline_max_size:
+                return False
+            future = get_executor().submit(self._transfer_inline, name)
+            return future.result(timeout=None if force
+                                 else self.inline_timeout)
+        except Exception:
+            # e.g. timed out, queue the transfer instead
+            return False
+
+    def _transfer_inline(self, name):
+        task, args, options = self.get_transfer_call(name)
+        if isinstance(task, type):
+            # an old-style task class, returning the registered task
+            task = task()
+        return task.attempt(*args, kwargs={}) is True
+
+    def get_transfer_call(self, name, cache_key=None):
+        """
+        Returns the call of the transfer task for the file with the given
+        name, a tuple of the task, its positional arguments and its
+        ``apply_async`` options.
+
+        :param name: file name
+        :type name: str
+        :param cache_key: the cache key to set after a successful task run
+        :type cache_key: str
+        :rtype: tuple
+        """
+        if cache_key is None:
+            cache_key = self.get_cache_key(name)
+        args = (name, cache_key, self.local_path, self.remote_path,
+                self.local_options, self.remote_options)
+        options = {'ignore_result': True} if self.ignore_result else {}
+        return self.task, args, options
+
+    @profiled
     def transfer(self, name, cache_key=None):
         """
         Transfers the file with the given name to the remote storage
@@ -214,11 +848,50 @@ class QueuedStorage(object):
         :type cache_key: str
         :rtype: task result
         """
+        return dispatch([self.get_transfer_call(name, cache_key)])[0]
+
+    @profiled
+    def transfer_many(self, names):
+        """
+        Transfers the files with the given names to the remote storage
+        backend by queuing the tasks at once.
+
+        :param names: file names
+        :type names: list
+        :rtype: list of task results
+        """
+        return dispatch(self.get_transfer_call(name) for name in names)
+
+    @profiled
+    def fetch(self, name, cache_key=None):
+        """
+        Copies the file with the given name from the remote to the local
+        storage backend by queuing the fetch task, unless that's already
+        queued for the file.
+
+        :param name: file name
+        :type name: str
+        :param cache_key: the cache key of the file
+        :type cache_key: str
+        :rtype: task result or ``None``
+        """
+        storage, stored_name = self.resolve(name)
+        if storage is self.local:
+            return None
         if cache_key is None:
             cache_key = self.get_cache_key(name)
-        return self.task.delay(name, cache_key,
-                               self.local_path, self.remote_path,
-                               self.local_options, self.remote_options)
+        if not cache.add('%s_fetch' % cache_key, True,
+                         settings.QUEUED_STORAGE_FETCH_TIMEOUT):
+            return None
+        remote_path, remote_options = self.remote_path, self.remote_options
+        if isinstance(remote_path, list):
+            # fetch from the nearest remote storage the file exists in
+            index = [remote is storage for remote in self.remotes].index(True)
+            remote_path, remote_options = remote_path[index], remote_options[index]
+        return self.fetch_task.delay(
+            name, cache_key, self.local_path, remote_path,
+            self.local_options, remote_options,
+            content_encoding=get_content_encoding(name, stored_name))
 
     def get_valid_name(self, name):
         """
@@ -231,22 +904,25 @@ class QueuedStorage(object):
         """
         return self.get_storage(name).get_valid_name(name)
 
+    @profiled
     def get_available_name(self, name):
         """
         Returns a filename that's free on both the local and remote storage
-        systems, and available for new content to be written to.
+        systems (all of them if multiple), and available for new content to
+        be written to.
 
         :param name: file name
         :type name: str
         :rtype: str
         """
-        local_available_name = self.local.get_available_name(name)
-        remote_available_name = self.remote.get_available_name(name)
-
-        if remote_available_name > local_available_name:
-            return remote_available_name
-        return local_available_name
-
+        available_name = self.local.get_available_name(name)
+        for remote in self.remotes:
+            remote_available_name = remote.get_available_name(name)
+            if remote_available_name > available_name:
+                available_name = remote_available_name
+        return available_name
+
+    @profiled
     def path(self, name):
         """
         Returns a local filesystem path where the file can be retrieved using
@@ -257,17 +933,94 @@ class QueuedStorage(object):
         :type name: str
         :rtype: str
         """
-        return self.get_storage(name).path(name)
+        storage, stored_name = self.resolve(name)
+        return storage.path(stored_name)
 
+    @profiled
     def delete(self, name):
         """
-        Deletes the specified file from the storage system.
+        Deletes the specified file from the storage system, in a task if
+        :attr:`~queued_storage.backends.QueuedStorage.queued_delete` is
+        set (see :meth:`~queued_storage.backends.QueuedStorage.delete_many`).
 
         :param name: file name
         :type name: str
         """
-        return self.get_storage(name).delete(name)
-
+        if self.queued_delete:
+            self.delete_many([name])
+            return
+        cache_key = self.get_cache_key(name)
+        cache.delete('%s_metadata' % cache_key)
+        Backlog(self.local).remove(cache_key)
+        storage, stored_name = self.resolve(name)
+        if storage is self.local and (self.prefer_local or self.read_through):
+            # the local copy may only be a cached copy of the remote file
+            storage.delete(name)
+            storage, stored_name = self.resolve(name)
+            if storage is self.local:
+                return
+        if storage is not self.local and len(self.remotes) > 1:
+            for remote in self.remotes:
+                remote.delete(stored_name)
+            return
+        return storage.delete(stored_name)
+
+    @profiled
+    def delete_many(self, names):
+        """
+        Deletes the files with the given names: their local copies right
+        away, and their remote copies by queuing a single
+        :attr:`~queued_storage.backends.QueuedStorage.delete_task`, which
+        deletes them in batches (see :class:`~queued_storage.tasks.Delete`).
+        The files are marked deleted in the cache at once, so they don't
+        exist anymore for the storage even before the task ran, and a
+        transfer still in progress doesn't record them as transferred.
+
+        :param names: file names
+        :type names: list
+        :rtype: task result or ``None``
+        """
+        names = list(names)
+        if not names:
+            return None
+        cache_keys = [self.get_cache_key(name) for name in names]
+        cached = cache.get_many(cache_keys)
+        backlog = Backlog(self.local)
+        remote_names = []
+        for name, cache_key in zip(names, cache_keys):
+            cache_result = cached.get(cache_key)
+            states = (cache_result if isinstance(cache_result, tuple)
+                      else (cache_result,))
+            encodings = [state for state in states
+                         if isinstance(state, six.string_types)]
+            if encodings:
+                remote_names.append([get_compressed_name(name, encodings[0])])
+            elif True in states:
+                remote_names.append([name])
+            else:
+                # not transferred yet (but maybe in progress) or the cache
+                # expired, so the file may be stored with any encoding
+                remote_names.append([name] + [
+                    get_compressed_name(name, encoding)
+                    for encoding in sorted(ENCODINGS)])
+            backlog.remove(cache_key)
+            self.local.delete(name)
+        # i.e. only in the local storage, where they're deleted already
+        cache.set_many(dict((cache_key, False) for cache_key in cache_keys))
+        # until the delete task removed the remote copies
+        cache.set_many(dict(('%s_deleted' % cache_key, True)
+                            for cache_key in cache_keys), None)
+        cache.delete_many(['%s_metadata' % cache_key
+                           for cache_key in cache_keys])
+        call = (self.delete_task,
+                (remote_names, cache_keys,
+                 self.remote_path, self.remote_options), {})
+        if self.on_commit:
+            dispatch_on_commit(call)
+            return None
+        return dispatch([call])[0]
+
+    @profiled
     def exists(self, name):
         """
         Returns ``True`` if a file referened by the given name already exists
@@ -278,19 +1031,159 @@ class QueuedStorage(object):
         :type name: str
         :rtype: bool
         """
-        return self.get_storage(name).exists(name)
+        storage, stored_name = self.resolve(name)
+        return storage.exists(stored_name)
 
+    @profiled
     def listdir(self, name):
         """
         Lists the contents of the specified path, returning a 2-tuple of lists;
         the first item being directories, the second item being files.
+        The contents of the local and the remote storage are merged (see
+        :meth:`~queued_storage.backends.QueuedStorage.iter_listdir`).
+
+        :param name: file name
+        :type name: str
+        :rtype: tuple
+        """
+        directories, files = [], []
+        for entry, is_directory in self.iter_listdir(name):
+            (directories if is_directory else files).append(entry)
+        return directories, files
+
+    @profiled
+    def listdir_page(self, name, cursor=None, limit=1000):
+        """
+        Lists a page of the contents of the specified path, like
+        :meth:`~queued_storage.backends.QueuedStorage.listdir`, returning a
+        3-tuple of the directories, the files and the cursor to pass to
+        get the next page, or ``None`` for the last page.
 
         :param name: file name
         :type name: str
+        :param cursor: the cursor returned with the previous page
+        :type cursor: str
+        :param limit: the maximum number of entries of the page
+        :type limit: int
         :rtype: tuple
         """
-        return self.get_storage(name).listdir(name)
+        # one more entry to know whether there's a next page
+        entries = list(islice(self.iter_listdir(name, cursor), limit + 1))
+        cursor = entries[limit - 1][0] if len(entries) > limit else None
+        directories, files = [], []
+        for entry, is_directory in entries[:limit]:
+            (directories if is_directory else files).append(entry)
+        return directories, files, cursor
+
+    def iter_listdir(self, name, cursor=None):
+        """
+        Yields the contents of the specified path in the local and the
+        remote storages as 2-tuples of the name of an entry and whether
+        it's a directory, sorted by name and each only once, including
+        files which are only in one of the storages (e.g. while they're
+        transferred).
+
+        If files are compressed (see
+        :attr:`~queued_storage.tasks.Transfer.compression`), compressed
+        remote files are listed with their original names (see
+        :func:`~queued_storage.compression.get_original_name`), otherwise
+        remote files are listed as they're named. The locations of the
+        listed remote files are added to the cache unless known already.
+
+        :param name: file name
+        :type name: str
+        :param cursor: the name of the entry to continue after
+        :type cursor: str
+        :rtype: generator
+        """
+        storages = [self.local] + list(self.remotes)
+        compression = self._get_compression()
+        content_types = getattr(
+            self.task, 'compression_content_types',
+            settings.QUEUED_STORAGE_COMPRESSION_CONTENT_TYPES)
+        listings = []
+        for index, storage in enumerate(storages):
+            try:
+                directories, files = storage.listdir(name)
+            except (IOError, OSError):
+                # e.g. the directory doesn't exist (yet) in this storage
+                continue
+            entries = [(entry, True, True) for entry in directories]
+            for entry in files:
+                state = True
+                if index and compression:
+                    entry, state = get_original_name(entry, content_types)
+                entries.append((entry, False, state or True))
+            listings.append([(entry, is_directory, index, state)
+                             for entry, is_directory, state
+                             in sorted(entries, key=lambda e: e[:2])
+                             if cursor is None or entry > cursor])
+
+        last, located = None, {}
+        for entry, is_directory, index, state in heapq.merge(*listings):
+            if not is_directory and index:
+                located.setdefault(posixpath.join(name, entry),
+                                   {})[index - 1] = state
+            if entry != last:
+                last = entry
+                yield entry, is_directory
+            if len(located) >= LISTDIR_LOCATE_BATCH_SIZE:
+                self._cache_located(located)
+                located = {}
+        self._cache_located(located)
+
+    def _cache_located(self, located):
+        # the states of each file in the remote storages it was listed in
+        if not located:
+            return
+        cache_keys = dict((self.get_cache_key(name), name)
+                          for name in located)
+        cached = cache.get_many(list(cache_keys))
+        missing = {}
+        for cache_key, name in cache_keys.items():
+            if cache_key in cached:
+                continue
+            if len(self.remotes) > 1:
+                missing[cache_key] = tuple(located[name].get(index)
+                                           for index in
+                                           range(len(self.remotes)))
+            else:
+                missing[cache_key] = located[name][0]
+        if missing:
+            cache.set_many(missing)
+
+    @profiled
+    def get_metadata(self, name):
+        """
+        Returns the metadata of the file with the given name recorded when
+        it was transferred to the remote storage, a dictionary with its
+        ``size``, ``modified_time``, ``created_time``, ``content_type`` and
+        ``checksum`` (see :func:`~queued_storage.utils.get_file_metadata`),
+        or ``None`` if not transferred yet.
+
+        :meth:`~queued_storage.backends.QueuedStorage.size`,
+        :meth:`~queued_storage.backends.QueuedStorage.get_modified_time` and
+        :meth:`~queued_storage.backends.QueuedStorage.get_created_time` use
+        it instead of asking the storage backends.
+
+        :param name: file name
+        :type name: str
+        :rtype: dict
+        """
+        return cache.get('%s_metadata' % self.get_cache_key(name))
 
+    def _get_metadata(self, name, key, method):
+        cache_key = self.get_cache_key(name)
+        metadata_key = '%s_metadata' % cache_key
+        cached = cache.get_many([cache_key, metadata_key])
+        metadata = cached.get(metadata_key)
+        note_lookup(bool(metadata))
+        if metadata and metadata.get(key) is not None:
+            return metadata[key]
+        storage, stored_name = self.resolve(name, cached.get(cache_key))
+        return getattr(storage, method)(stored_name)
+
+    @profiled
     def size(self, name):
         """
         Returns the total size, in bytes, of the file specified by name.
@@ -299,8 +1192,9 @@ class QueuedStorage(object):
         :type name: str
         :rtype: int
         """
-        return self.get_storage(name).size(name)
+        return self._get_metadata(name, 'size', 'size')
 
+    @profiled
     def url(self, name):
         """
         Returns an absolute URL where the file's contents can be accessed
@@ -310,8 +1204,10 @@ class QueuedStorage(object):
         :type name: str
         :rtype: str
         """
-        return self.get_storage(name).url(name)
+        storage, stored_name = self.resolve(name)
+        return storage.url(stored_name)
 
+    @profiled
     def accessed_time(self, name):
         """
         Returns the last accessed time (as datetime object) of the file
@@ -321,8 +1217,10 @@ class QueuedStorage(object):
         :type name: str
         :rtype: :class:`~python:datetime.datetime`
         """
-        return self.get_storage(name).accessed_time(name)
+        storage, stored_name = self.resolve(name)
+        return storage.accessed_time(stored_name)
 
+    @profiled
     def created_time(self, name):
         """
         Returns the creation time (as datetime object) of the file
@@ -332,8 +1230,10 @@ class QueuedStorage(object):
         :type name: str
         :rtype: :class:`~python:datetime.datetime`
         """
-        return self.get_storage(name).created_time(name)
+        storage, stored_name = self.resolve(name)
+        return storage.created_time(stored_name)
 
+    @profiled
     def modified_time(self, name):
         """
         Returns the last modified time (as datetime object) of the file
@@ -343,8 +1243,10 @@ class QueuedStorage(object):
         :type name: str
         :rtype: :class:`~python:datetime.datetime`
         """
-        return self.get_storage(name).modified_time(name)
+        storage, stored_name = self.resolve(name)
+        return storage.modified_time(stored_name)
 
+    @profiled
     def get_accessed_time(self, name):
         """
         Django +1.10
@@ -355,8 +1257,10 @@ class QueuedStorage(object):
         :type name: str
         :rtype: :class:`~python:datetime.datetime`
         """
-        return self.get_storage(name).get_accessed_time(name)
+        storage, stored_name = self.resolve(name)
+        return storage.get_accessed_time(stored_name)
 
+    @profiled
     def get_created_time(self, name):
         """
         Django +1.10
@@ -367,9 +1271,9 @@ class QueuedStorage(object):
         :type name: str
         :rtype: :class:`~python:datetime.datetime`
         """
+        return self._get_metadata(name, 'created_time', 'get_created_time')
 
-        return self.get_storage(name).get_created_time(name)
-
+    @profiled
     def get_modified_time(self, name):
         """
         Django +1.10
@@ -380,8 +1284,7 @@ class QueuedStorage(object):
         :type name: str
         :rtype: :class:`~python:datetime.datetime`
         """
-
-        return self.get_storage(name).get_modified_time(name)
+        return self._get_metadata(name, 'modified_time', 'get_modified_time')
 
     def generate_filename(self, filename):
         return self.get_storage(filename).generate_filename(filename)
@@ -406,9 +1309,10 @@ class QueuedS3BotoStorage(QueuedFileSystemStorage):
     A custom :class:`~queued_storage.backends.QueuedFileSystemStorage`
     subclass which uses the ``S3BotoStorage`` storage of the
     `django-storages <https://django-storages.readthedocs.io/>`_ app as
-    the remote storage.
+    the remote storage, deleting files in batches (see
+    :mod:`queued_storage.s3boto`).
     """
-    def __init__(self, remote='storages.backends.s3boto.S3BotoStorage', *args, **kwargs):
+    def __init__(self, remote='queued_storage.s3boto.S3BotoStorage', *args, **kwargs):
         super(QueuedS3BotoStorage, self).__init__(remote=remote, *args, **kwargs)
 
 
@@ -0,0 +1,158 @@
+"""
+Helpers to compress the content of files transferred to the remote storage.
+
+Compressed files are saved in the remote storage with the file extension of
+their content encoding appended to their name (e.g. ``data.csv.gz``), which
+is the convention of Python's :mod:`mimetypes` module, so that storages
+deriving the ``Content-Encoding`` of a file from its name serve it
+transparently to web browsers.
+"""
+import fnmatch
+import gzip
+import mimetypes
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import File
+
+from .conf import settings
+
+#: The supported content encodings and their file extensions.
+ENCODINGS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+#: The maximum size in bytes of compressed content kept in memory before
+#: it's written to a temporary file.
+SPOOL_SIZE = 2 * 1024 * 1024
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImproperlyConfigured("The 'zstd' content encoding requires "
+                                   "the zstandard package to be installed.")
+    return zstandard
+
+
+def check_encoding(encoding):
+    if encoding not in ENCODINGS:
+        raise ImproperlyConfigured("Unknown content encoding '%s', use one "
+                                   "of: %s" % (encoding,
+                                               ', '.join(sorted(ENCODINGS))))
+
+
+def get_compressed_name(name, encoding):
+    """
+    Returns the name of the file with the given name when compressed
+    with the given content encoding (if any).
+    """
+    if not encoding:
+        return name
+    check_encoding(encoding)
+    return name + ENCODINGS[encoding]
+
+
+def get_content_encoding(name, compressed_name):
+    """
+    Returns the content encoding of the compressed file with the given
+    name, given its original name.
+    """
+    for encoding, extension in ENCODINGS.items():
+        if compressed_name == name + extension:
+            return encoding
+    return None
+
+
+def get_original_name(stored_name, content_types):
+    """
+    Returns the name of the file stored with the given name in the remote
+    storage and the content encoding it's compressed with, or ``None``,
+    given the content type patterns of the compressed files (so that e.g.
+    ``archive.tar.gz`` isn't mistaken for a compressed ``archive.tar``).
+
+    :rtype: tuple
+    """
+    for encoding, extension in ENCODINGS.items():
+        if stored_name.endswith(extension):
+            name = stored_name[:-len(extension)]
+            if should_compress(name, 0, content_types):
+                return name, encoding
+    return stored_name, None
+
+
+def should_compress(name, size, content_types, min_size=0):
+    """
+    Returns whether a file with the given name and size should be
+    compressed, given the content type patterns (e.g. ``'text/*'``)
+    and minimum size to compress.
+    """
+    if size < (min_size or 0):
+        return False
+    content_type = mimetypes.guess_type(name)[0]
+    if content_type is None:
+        return False
+    return any(fnmatch.fnmatch(content_type, pattern)
+               for pattern in content_types)
+
+
+def compress(content, encoding):
+    """
+    Compresses the given file with the given content encoding in chunks,
+    returning a file with the compressed content which is only written to
+    disk if it exceeds :data:`SPOOL_SIZE`.
+
+    :rtype: :class:`~django:django.core.files.File`
+    """
+    check_encoding(encoding)
+    compressed = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    if encoding == 'zstd':
+        _zstandard().ZstdCompressor().copy_stream(content, compressed)
+    else:
+        stream = gzip.GzipFile(filename='', mode='wb', fileobj=compressed)
+        try:
+            for chunk in content.chunks():
+                stream.write(chunk)
+        finally:
+            stream.close()
+    compressed.seek(0)
+    return File(compressed, name=get_compressed_name(content.name, encoding))
+
+
+def decompress(content, encoding):
+    """
+    Returns a file object reading the decompressed content of the given
+    file object compressed with the given content encoding.
+    """
+    check_encoding(encoding)
+    if encoding == 'zstd':
+        return _zstandard().ZstdDecompressor().stream_reader(content)
+    return gzip.GzipFile(filename='', mode='rb', fileobj=content)
+
+
+def locate(storage, name, encoding=None):
+    """
+    Returns how the file with the given name is stored in the given storage,
+    ``True`` if uncompressed, the content encoding if compressed, or
+    ``False`` if it doesn't exist. Compressed copies are looked for with the
+    given content encoding first (e.g. the one of the transfer task), then
+    the one configured in
+    :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_COMPRESSION` and
+    then all others, but only if either is set, so that locating files
+    takes a single request if files aren't compressed.
+    """
+    if storage.exists(name):
+        return True
+    if not (encoding or settings.QUEUED_STORAGE_COMPRESSION):
+        return False
+    tried = set()
+    for encoding in ([encoding, settings.QUEUED_STORAGE_COMPRESSION] +
+                     sorted(ENCODINGS)):
+        if not encoding or encoding in tried:
+            continue
+        tried.add(encoding)
+        if storage.exists(get_compressed_name(name, encoding)):
+            return encoding
+    return False
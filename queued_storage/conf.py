@@ -7,3 +7,35 @@ class QueuedStorageConf(AppConf):
     RETRIES = 5
     RETRY_DELAY = 60
     CACHE_PREFIX = 'queued_storage'
+    CACHE_GENERATION_TTL = 5
+    BACKENDS = {}
+    LOCAL_CACHE_MAX_BYTES = None
+    LOCAL_CACHE_MAX_FILES = None
+    LOCAL_CACHE_EVICTION_INTERVAL = 60
+    READ_THROUGH_MAX_SIZE = None
+    FETCH_TIMEOUT = 300
+    COMPRESSION = None
+    COMPRESSION_CONTENT_TYPES = [
+        'text/*',
+        'application/javascript',
+        'application/json',
+        'application/xml',
+        'image/svg+xml',
+    ]
+    COMPRESSION_MIN_SIZE = 1024
+    THREAD_POOL_SIZE = 10
+    TRANSFER_LEASE_TIMEOUT = 300
+    PARTIAL_TRANSFER_MAX_AGE = 86400
+    INLINE_MAX_SIZE = None
+    INLINE_TIMEOUT = 2
+    BACKLOG_MAX_FILES = None
+    BACKLOG_MAX_BYTES = None
+    BACKLOG_POLICY = 'reject'
+    BACKLOG_THROTTLE_TIMEOUT = 5
+    STAGING_MAX_MEMORY_SIZE = 65536
+    STAGING_CACHE = None
+    DELETE_BATCH_SIZE = 1000
+    WARM_UP = False
+    BACKEND_POOL_SIZE = None
+    BACKEND_POOL_MAX_AGE = 3600
+    PROFILER_N_PLUS_ONE_THRESHOLD = 10
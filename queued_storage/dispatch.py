@@ -0,0 +1,91 @@
+"""
+Helpers to queue many transfers at once, e.g. when the database
+transaction the files were saved in is committed.
+"""
+import weakref
+
+from django.db import transaction
+
+
+def dispatch(calls):
+    """
+    Queues the given task calls at once. Calls of Celery tasks are sent as
+    a single :class:`celery.group`, reusing one broker connection for all
+    messages, any other task is queued with its ``delay`` method.
+
+    :param calls: the task calls, tuples of a task, its positional
+                  arguments and its ``apply_async`` options
+    :type calls: list
+    :rtype: list of task results
+    """
+    calls = list(calls)
+    if len(calls) > 1 and all(hasattr(task, 'signature')
+                              for task, _, _ in calls):
+        from celery import group
+        return group([task.signature(args, options=options)
+                      for task, args, options in calls]).apply_async().results
+    results = []
+    for task, args, options in calls:
+        if options and hasattr(task, 'apply_async'):
+            results.append(task.apply_async(args, **options))
+        else:
+            results.append(task.delay(*args))
+    return results
+
+
+class TransferBatch(object):
+    """
+    The transfers queued during a database transaction, dispatched at once
+    by a single commit hook, registered with
+    :func:`~django.db.transaction.on_commit` for the first transfer.
+
+    The connection only holds a weak reference to the batch, the commit
+    hook holds the only strong one. If Django drops the hook because the
+    transaction (or the savepoint the first transfer was queued in) is
+    rolled back, the batch is gone with it and the next transfer starts a
+    new one. Transfers queued in other savepoints which are rolled back
+    are dispatched nonetheless, their files were saved to the local
+    storage anyway.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.calls = []
+        transaction.on_commit(self.dispatch, using=connection.alias)
+
+    def add(self, call):
+        self.calls.append(call)
+
+    def dispatch(self):
+        ref = getattr(self.connection, 'queued_storage_batch', None)
+        if ref is not None and ref() is self:
+            # transfers queued later start a new batch
+            self.connection.queued_storage_batch = None
+        calls, self.calls = self.calls, []
+        if calls:
+            dispatch(calls)
+
+
+def dispatch_on_commit(call, using=None):
+    """
+    Queues the given task call when the current database transaction is
+    committed, together with all other calls queued during the transaction.
+    Outside of a transaction the call is queued right away.
+
+    Requires Django 1.9 or newer.
+
+    :param call: the task call, a tuple of a task, its positional arguments
+                 and its ``apply_async`` options
+    :type call: tuple
+    :param using: the alias of the database connection
+    :type using: str
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        dispatch([call])
+        return
+    ref = getattr(connection, 'queued_storage_batch', None)
+    batch = ref() if ref is not None else None
+    if batch is None:
+        batch = TransferBatch(connection)
+        connection.queued_storage_batch = weakref.ref(batch)
+    batch.add(call)
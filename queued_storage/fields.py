@@ -1,5 +1,36 @@
+from itertools import islice
+
+import six
+
+from django.core.cache import cache
 from django.db.models.fields.files import FileField, FieldFile
 
+from .backends import QueuedStorage
+from .signals import file_transferred
+from .utils import is_transferred
+
+
+#: The value of location fields of files transferred to the remote storage
+#: without compression, otherwise it's the content encoding of the file.
+IDENTITY = 'identity'
+
+
+def get_location(cache_result):
+    """
+    Returns the value of a location field (see
+    :class:`~queued_storage.fields.QueuedFileField`) for the given cached
+    location of a file.
+
+    :param cache_result: the cached location of a file
+    :rtype: str or ``None``
+    """
+    if isinstance(cache_result, tuple):
+        # the location in the nearest of multiple remote storages
+        cache_result = cache_result[0]
+    if isinstance(cache_result, six.string_types):
+        return cache_result
+    return IDENTITY if cache_result else None
+
 
 class QueuedFieldFile(FieldFile):
     """
@@ -13,6 +44,45 @@ class QueuedFieldFile(FieldFile):
         """
         return self.storage.transfer(self.name)
 
+    @property
+    def location(self):
+        """
+        The location of the file as recorded in the field's location
+        field, ``True`` if it's transferred to the remote storage (or the
+        content encoding it's compressed with), or ``None`` if unknown.
+        """
+        location_field = self.field.location_field
+        location = location_field and getattr(self.instance, location_field)
+        if not location:
+            return None
+        return True if location == IDENTITY else location
+
+    @property
+    def url(self):
+        self._require_file()
+        location = self.location
+        if location and isinstance(self.storage, QueuedStorage):
+            storage, stored_name = self.storage.resolve(self.name, location)
+            return storage.url(stored_name)
+        return self.storage.url(self.name)
+
+    def save(self, name, content, save=True):
+        super(QueuedFieldFile, self).save(name, content, save=False)
+        location_field = self.field.location_field
+        if location_field and isinstance(self.storage, QueuedStorage):
+            # the file may be transferred already, before the object is saved
+            cache_result = cache.get(self.storage.get_cache_key(self.name))
+            setattr(self.instance, location_field, get_location(cache_result))
+        if save:
+            self.instance.save()
+    save.alters_data = True
+
+    def delete(self, save=True):
+        if self.field.location_field:
+            setattr(self.instance, self.field.location_field, None)
+        super(QueuedFieldFile, self).delete(save=save)
+    delete.alters_data = True
+
 
 class QueuedFileField(FileField):
     """
@@ -37,5 +107,106 @@ class QueuedFileField(FileField):
         my_obj.save()
         # Transfer to remote location:
         my_obj.image.transfer()
+
+    Optionally, the location of the files can be recorded in another field
+    of the model, which is updated after each transfer and used to get
+    their URLs without looking up their location in the cache, e.g.:
+
+    .. code-block:: python
+
+        class MyModel(models.Model):
+            image = QueuedFileField(storage=QueuedS3BotoStorage(),
+                                    location_field='image_location')
+            image_location = models.CharField(max_length=8, null=True,
+                                              editable=False)
+
+    :param location_field: the name of the field to record the location
+                           of the files in, ``None`` until transferred,
+                           then ``'identity'`` or the content encoding
+                           the file is compressed with
+    :type location_field: str
     """
     attr_class = QueuedFieldFile
+
+    def __init__(self, verbose_name=None, name=None, location_field=None,
+                 **kwargs):
+        self.location_field = location_field
+        super(QueuedFileField, self).__init__(verbose_name, name, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(QueuedFileField, self).deconstruct()
+        if self.location_field:
+            kwargs['location_field'] = self.location_field
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(QueuedFileField, self).contribute_to_class(cls, name, **kwargs)
+        if self.location_field and not cls._meta.abstract:
+            file_transferred.connect(self.update_location)
+
+    def update_location(self, sender, name, local, remote,
+                        content_encoding=None, **kwargs):
+        """
+        Records the location of the transferred file with the given name
+        in the location field of all objects referencing it, with a single
+        update query. Connected to the
+        :data:`~queued_storage.signals.file_transferred` signal.
+        """
+        storage = self.storage
+        if not (isinstance(storage, QueuedStorage) and
+                _same_backend(storage.local, local) and
+                _same_backend(storage.remote, remote)):
+            return
+        self.model._base_manager.filter(**{self.name: name}).update(
+            **{self.location_field: content_encoding or IDENTITY})
+
+
+def _same_backend(backend, other):
+    if backend == other:
+        return True
+    # e.g. instances of a pool, see queued_storage.utils.BackendPool
+    return (backend.__class__ is other.__class__ and
+            hasattr(other, 'deconstruct') and
+            backend.deconstruct() == other.deconstruct())
+
+
+def transfer_queued_files(queryset, field, chunk_size=1000):
+    """
+    Transfers the files of the given field of all objects in the given
+    queryset to the remote storage, e.g. to backfill a delayed storage.
+
+    The file names are streamed from the database and handled in chunks
+    of the given size, with a single cache lookup per chunk to skip the
+    files already transferred and a single dispatch of the transfers of
+    the remaining ones (see
+    :meth:`~queued_storage.backends.QueuedStorage.transfer_many`), so
+    the memory usage doesn't depend on the size of the queryset.
+
+    :param queryset: the objects to transfer the files of
+    :type queryset: :class:`~django:django.db.models.query.QuerySet`
+    :param field: the name of the file field
+    :type field: str
+    :param chunk_size: the number of files to handle at once
+    :type chunk_size: int
+    :returns: the number of queued transfers
+    :rtype: int
+    """
+    storage = queryset.model._meta.get_field(field).storage
+    names = (queryset.exclude(**{field: ''})
+                     .exclude(**{'%s__isnull' % field: True})
+                     .order_by().values_list(field, flat=True)
+                     .iterator())
+    queued = 0
+    while True:
+        chunk = list(islice(names, chunk_size))
+        if not chunk:
+            return queued
+        cache_keys = dict((storage.get_cache_key(name), name)
+                          for name in chunk)
+        cached = cache.get_many(list(cache_keys))
+        transferred = set(name for cache_key, name in cache_keys.items()
+                          if is_transferred(cached.get(cache_key)))
+        pending = [name for name in chunk if name not in transferred]
+        if pending:
+            storage.transfer_many(pending)
+            queued += len(pending)
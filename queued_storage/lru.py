@@ -0,0 +1,120 @@
+"""
+Helpers to use the local storage as a bounded cache of files that have
+already been transferred to the remote storage, deleting the least recently
+used local copies first when a quota is exceeded.
+
+Accesses are tracked using the file system's access time, which is updated
+explicitly (but at most once every :data:`TOUCH_INTERVAL` seconds per file)
+so it doesn't depend on the ``atime`` mount options.
+"""
+import os
+import posixpath
+import time
+
+from .compression import locate
+
+#: The minimum number of seconds between two updates of the access time
+#: of the same file.
+TOUCH_INTERVAL = 60
+
+
+def touch(storage, name):
+    """
+    Records an access of the file with the given name in the given storage
+    and returns whether the file exists.
+
+    :param storage: storage backend instance
+    :param name: file name
+    :type name: str
+    :rtype: bool
+    """
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        return storage.exists(name)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    now = time.time()
+    if now - stat.st_atime > TOUCH_INTERVAL:
+        try:
+            os.utime(path, (now, stat.st_mtime))
+        except OSError:
+            pass
+    return True
+
+
+def walk(storage, path=''):
+    """
+    Yields the names of all files in the given storage below the given path.
+    """
+    directories, files = storage.listdir(path)
+    for name in files:
+        yield posixpath.join(path, name)
+    for directory in directories:
+        for name in walk(storage, posixpath.join(path, directory)):
+            yield name
+
+
+def file_stats(storage, name):
+    """
+    Returns the last accessed time (as a timestamp) and size of the file
+    with the given name.
+    """
+    try:
+        stat = os.stat(storage.path(name))
+    except NotImplementedError:
+        get_accessed_time = getattr(storage, 'get_accessed_time',
+                                    getattr(storage, 'accessed_time', None))
+        accessed_time = get_accessed_time(name)
+        return time.mktime(accessed_time.timetuple()), storage.size(name)
+    return stat.st_atime, stat.st_size
+
+
+def evict(local, remote, max_bytes=None, max_files=None, encoding=None):
+    """
+    Deletes the least recently used files from the local storage until
+    neither the total size nor the number of its files exceeds the given
+    quotas. Files that don't exist in the remote storage (e.g. because they
+    haven't been transferred yet) are never deleted.
+
+    :param local: local storage backend instance
+    :param remote: remote storage backend instance
+    :param max_bytes: maximum total size of the local files in bytes
+    :type max_bytes: int
+    :param max_files: maximum number of local files
+    :type max_files: int
+    :param encoding: the content encoding the remote copies are compressed
+                     with, if any (see
+                     :func:`~queued_storage.compression.locate`)
+    :type encoding: str
+    :returns: the names of the deleted files
+    :rtype: list
+    """
+    if max_bytes is None and max_files is None:
+        return []
+    files = []
+    total_size = 0
+    for name in walk(local):
+        try:
+            accessed_time, size = file_stats(local, name)
+        except OSError:
+            # deleted in the meantime
+            continue
+        files.append((accessed_time, size, name))
+        total_size += size
+    total_files = len(files)
+
+    evicted = []
+    for accessed_time, size, name in sorted(files):
+        if ((max_bytes is None or total_size <= max_bytes) and
+                (max_files is None or total_files <= max_files)):
+            break
+        if not locate(remote, name, encoding):
+            continue
+        local.delete(name)
+        evicted.append(name)
+        total_size -= size
+        total_files -= 1
+    return evicted
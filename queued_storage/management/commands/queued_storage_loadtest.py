@@ -0,0 +1,251 @@
+"""
+Drives synthetic uploads through :meth:`QueuedStorage.save()
+<queued_storage.backends.QueuedStorage.save>` and the transfer task, to
+size worker pools and caches. It runs offline, between temporary
+directories, with the remote storage simulated by a
+:class:`~queued_storage.storages.LatencyFileSystemStorage` and the
+transfers queued in memory for worker threads instead of Celery.
+
+Requires Django 1.8 or newer.
+"""
+import bisect
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from six.moves import queue
+
+import django
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+
+from ...backends import QueuedStorage
+from ...utils import import_attribute
+
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_size(value):
+    """
+    Returns the number of bytes of the given size, e.g. ``'100k'``.
+    """
+    value = value.strip().lower()
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    try:
+        return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise CommandError("Invalid file size '%s'." % value)
+
+
+def parse_sizes(value):
+    """
+    Returns the sizes and weights of the given size distribution, e.g.
+    ``'1k:70,100k:25,1m:5'``, as a list of tuples.
+    """
+    sizes = []
+    for item in value.split(','):
+        size, _, weight = item.partition(':')
+        try:
+            weight = float(weight or 1)
+        except ValueError:
+            raise CommandError("Invalid weight of file size '%s'." % item)
+        sizes.append((parse_size(size), weight))
+    if not sizes or sum(weight for size, weight in sizes) <= 0:
+        raise CommandError("Invalid file size distribution '%s'." % value)
+    return sizes
+
+
+def percentile(values, percent):
+    """
+    Returns the given percentile of the given sorted values (nearest rank).
+    """
+    if not values:
+        return 0
+    index = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+class TransferQueue(object):
+    """
+    Stands in for the transfer task of the storage, queuing the transfers
+    in memory together with the start time and size of their saves.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.saving = threading.local()
+
+    def delay(self, *args):
+        self.queue.put((self.saving.started, self.saving.size, args))
+
+
+class Command(BaseCommand):
+    help = ("Generates synthetic uploads through a queued storage and "
+            "reports ingest rate, queue depth, save-to-remote latency and "
+            "worker throughput.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--files', type=int, default=1000,
+            help="The number of files to save (default: 1000).")
+        parser.add_argument(
+            '--concurrency', type=int, default=4,
+            help="The number of threads saving files (default: 4).")
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help="The number of threads transferring files (default: 4).")
+        parser.add_argument(
+            '--sizes', default='1k:70,100k:25,1m:5',
+            help="The distribution of file sizes, as comma separated sizes "
+                 "and weights (default: '1k:70,100k:25,1m:5').")
+        parser.add_argument(
+            '--remote-latency', type=float, default=0.0,
+            help="The seconds the simulated remote storage waits before "
+                 "saving a file (default: 0).")
+        parser.add_argument(
+            '--task', default='queued_storage.tasks.Transfer',
+            help="The transfer task class (default: "
+                 "'queued_storage.tasks.Transfer').")
+        parser.add_argument(
+            '--fast-transfer', action='store_true',
+            help="Transfer files on the file system instead of through the "
+                 "storage API, see Transfer.fast_transfer.")
+        parser.add_argument(
+            '--sample-interval', type=float, default=0.5,
+            help="The seconds between queue depth samples (default: 0.5).")
+        parser.add_argument(
+            '--seed', type=int, default=None,
+            help="The seed of the random file sizes.")
+
+    def handle(self, **options):
+        if django.VERSION < (1, 8):
+            # the options are declared with add_arguments
+            raise CommandError("The queued_storage_loadtest command "
+                               "requires Django 1.8 or newer.")
+        if options['files'] < 1 or options['concurrency'] < 1 or \
+                options['workers'] < 1:
+            raise CommandError("The number of files, the concurrency and "
+                               "the number of workers must be positive.")
+        sizes = parse_sizes(options['sizes'])
+        local_dir, remote_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        try:
+            self.load(sizes, local_dir, remote_dir, options)
+        finally:
+            shutil.rmtree(local_dir, ignore_errors=True)
+            shutil.rmtree(remote_dir, ignore_errors=True)
+
+    def load(self, sizes, local_dir, remote_dir, options):
+        transfers = TransferQueue()
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='queued_storage.storages.LatencyFileSystemStorage',
+            local_options={'location': local_dir},
+            remote_options={'location': remote_dir,
+                            'latency': options['remote_latency']},
+            cache_prefix='queued_storage_loadtest_%s' % uuid.uuid4().hex)
+        storage.task = transfers
+        task = import_attribute(options['task'])()
+        task.fast_transfer = options['fast_transfer']
+
+        rng = random.Random(options['seed'])
+        cumulative = []
+        for size, weight in sizes:
+            cumulative.append(weight + (cumulative[-1] if cumulative else 0))
+        file_sizes = [sizes[bisect.bisect(cumulative,
+                                          rng.random() * cumulative[-1])][0]
+                      for index in range(options['files'])]
+        block = bytes(bytearray(rng.getrandbits(8) for _ in range(65536)))
+
+        indexes = queue.Queue()
+        for index in range(options['files']):
+            indexes.put(index)
+        save_times, transfer_times, failed = [], [], []
+        transferred = [0, 0]
+        lock = threading.Lock()
+
+        def save():
+            while True:
+                try:
+                    index = indexes.get_nowait()
+                except queue.Empty:
+                    return
+                size = file_sizes[index]
+                content = (block * (size // len(block) + 1))[:size]
+                transfers.saving.started = started = time.time()
+                transfers.saving.size = size
+                storage.save('loadtest/%d.bin' % index, ContentFile(content))
+                with lock:
+                    save_times.append(time.time() - started)
+
+        def work():
+            while True:
+                item = transfers.queue.get()
+                if item is None:
+                    return
+                started, size, args = item
+                try:
+                    task.run(*args)
+                except Exception:
+                    with lock:
+                        failed.append(args[0])
+                    continue
+                with lock:
+                    transfer_times.append(time.time() - started)
+                    transferred[0] += 1
+                    transferred[1] += size
+
+        depths = []
+        done = threading.Event()
+        started = time.time()
+
+        def sample():
+            while not done.wait(options['sample_interval']):
+                depths.append((time.time() - started,
+                               transfers.queue.qsize()))
+
+        savers = [threading.Thread(target=save)
+                  for _ in range(options['concurrency'])]
+        workers = [threading.Thread(target=work)
+                   for _ in range(options['workers'])]
+        sampler = threading.Thread(target=sample)
+        for thread in savers + workers + [sampler]:
+            thread.daemon = True
+            thread.start()
+        for thread in savers:
+            thread.join()
+        ingest_time = time.time() - started
+        for _ in workers:
+            transfers.queue.put(None)
+        for thread in workers:
+            thread.join()
+        total_time = time.time() - started
+        done.set()
+        sampler.join()
+
+        megabytes = sum(file_sizes) / 1024.0 ** 2
+        self.stdout.write(
+            "Saved %d files (%.1f MB) in %.2fs: %.1f files/s, %.1f MB/s" %
+            (len(save_times), megabytes, ingest_time,
+             len(save_times) / ingest_time, megabytes / ingest_time))
+        self.report_latency("Save latency", save_times)
+        transferred_megabytes = transferred[1] / 1024.0 ** 2
+        self.stdout.write(
+            "Transferred %d files (%.1f MB) in %.2fs with %d workers: "
+            "%.1f files/s, %.1f MB/s, %d failed" %
+            (transferred[0], transferred_megabytes, total_time,
+             len(workers), transferred[0] / total_time,
+             transferred_megabytes / total_time, len(failed)))
+        self.report_latency("Save-to-remote latency", transfer_times)
+        self.stdout.write("Queue depth:")
+        for elapsed, depth in depths:
+            self.stdout.write("  %6.1fs %8d" % (elapsed, depth))
+
+    def report_latency(self, title, times):
+        times = sorted(times)
+        self.stdout.write(
+            "%s: p50 %.1fms, p90 %.1fms, p99 %.1fms, max %.1fms" %
+            ((title,) + tuple(percentile(times, percent) * 1000
+                              for percent in (50, 90, 99, 100))))
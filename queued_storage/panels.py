@@ -0,0 +1,63 @@
+"""
+A panel for the `Django Debug Toolbar`_ showing the calls of
+:class:`~queued_storage.backends.QueuedStorage` methods made while handling
+a request, see :mod:`queued_storage.profiling`::
+
+    DEBUG_TOOLBAR_PANELS = [
+        # ...
+        'queued_storage.panels.QueuedStoragePanel',
+    ]
+
+.. _`Django Debug Toolbar`: https://django-debug-toolbar.readthedocs.io/
+"""
+from django.utils.html import format_html, format_html_join
+
+from debug_toolbar.panels import Panel
+
+from . import profiling
+
+
+class QueuedStoragePanel(Panel):
+    """
+    Lists the storage calls of the request and the N+1 patterns among them.
+    """
+    title = 'Queued storage'
+
+    @property
+    def nav_subtitle(self):
+        stats = self.get_stats()
+        return '%d calls in %.2fms' % (len(stats.get('calls', [])),
+                                       stats.get('duration', 0) * 1000)
+
+    def enable_instrumentation(self):
+        profiling.start()
+
+    def disable_instrumentation(self):
+        profile = profiling.stop()
+        if profile is not None:
+            self.record_stats({
+                'calls': profile.calls,
+                'duration': profile.duration,
+                'n_plus_one': profile.n_plus_one(),
+            })
+
+    @property
+    def content(self):
+        stats = self.get_stats()
+        warnings = format_html_join(
+            '', '<p><strong>QueuedStorage.{} was called for {} files with '
+                'a cache lookup each.</strong></p>',
+            stats.get('n_plus_one', []))
+        rows = format_html_join(
+            '', '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td>'
+                '<td>{}</td><td>{}ms</td></tr>',
+            # the arguments are escaped (to strings) before formatting
+            ((call['method'], call['name'], call['cache_hits'],
+              call['cache_misses'], call['backend'] or '',
+              '%.2f' % (call['duration'] * 1000))
+             for call in stats.get('calls', [])))
+        return format_html(
+            '{}<table><thead><tr><th>Method</th><th>Name</th>'
+            '<th>Cache hits</th><th>Cache misses</th><th>Backend</th>'
+            '<th>Duration</th></tr></thead><tbody>{}</tbody></table>',
+            warnings, rows)
@@ -0,0 +1,179 @@
+"""
+Opt-in profiling of the calls of :class:`~queued_storage.backends.QueuedStorage`
+methods, e.g. to find views which look up the locations of many files one by
+one. Add the middleware to your ``MIDDLEWARE`` setting::
+
+    MIDDLEWARE = [
+        'queued_storage.profiling.ProfilerMiddleware',
+        # ...
+    ]
+
+It adds the number of storage calls and their total duration to each
+response as the ``X-Queued-Storage-Calls`` and ``X-Queued-Storage-Time``
+headers, logs the calls to the ``queued_storage.profiling`` logger and warns
+about N+1 patterns (see
+:attr:`~queued_storage.conf.settings.QUEUED_STORAGE_PROFILER_N_PLUS_ONE_THRESHOLD`).
+
+Alternatively, add the ``'queued_storage.panels.QueuedStoragePanel'`` panel
+to the ``DEBUG_TOOLBAR_PANELS`` setting of the Django Debug Toolbar.
+"""
+import functools
+import logging
+import threading
+import time
+from collections import Counter
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:  # pragma: no cover
+    # Django < 1.10
+    MiddlewareMixin = object
+
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+
+class Profile(object):
+    """
+    The storage calls of a thread, each a dictionary of the storage
+    ``method``, the file ``name``, the number of ``cache_hits`` and
+    ``cache_misses`` when looking up the file's location, the ``backend``
+    used (``'local'`` or ``'remote'`` and the class name) and the
+    ``duration`` in seconds.
+    """
+    def __init__(self):
+        self.calls = []
+
+    @property
+    def duration(self):
+        """
+        The total duration of the calls in seconds.
+        """
+        return sum(call['duration'] for call in self.calls)
+
+    def n_plus_one(self, threshold=None):
+        """
+        Returns the storage methods called for at least the given number of
+        different files (default: see
+        :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_PROFILER_N_PLUS_ONE_THRESHOLD`)
+        with a cache lookup each, e.g. ``url`` in a template loop, as a list
+        of tuples of the method and the number of files.
+
+        :rtype: list
+        """
+        if threshold is None:
+            threshold = settings.QUEUED_STORAGE_PROFILER_N_PLUS_ONE_THRESHOLD
+        names = {}
+        for call in self.calls:
+            if call['cache_hits'] or call['cache_misses']:
+                names.setdefault(call['method'], set()).add(call['name'])
+        return sorted((method, len(method_names))
+                      for method, method_names in names.items()
+                      if len(method_names) >= threshold)
+
+    def summary(self):
+        """
+        Returns the number of calls per storage method.
+
+        :rtype: dict
+        """
+        return dict(Counter(call['method'] for call in self.calls))
+
+
+def start():
+    """
+    Starts recording the storage calls of the current thread.
+
+    :rtype: :class:`~queued_storage.profiling.Profile`
+    """
+    _state.profile = Profile()
+    _state.call = None
+    return _state.profile
+
+
+def stop():
+    """
+    Stops recording the storage calls of the current thread.
+
+    :returns: the recorded profile, if any
+    :rtype: :class:`~queued_storage.profiling.Profile`
+    """
+    profile = getattr(_state, 'profile', None)
+    _state.profile = _state.call = None
+    return profile
+
+
+def profiled(method):
+    """
+    Decorates a storage method to record its calls while profiling, except
+    the ones made by other recorded storage methods.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profile = getattr(_state, 'profile', None)
+        if profile is None or _state.call is not None:
+            return method(self, *args, **kwargs)
+        call = _state.call = {
+            'method': method.__name__,
+            'name': args[0] if args else kwargs.get('name'),
+            'cache_hits': 0,
+            'cache_misses': 0,
+            'backend': None,
+        }
+        started = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            call['duration'] = time.time() - started
+            _state.call = None
+            profile.calls.append(call)
+    return wrapper
+
+
+def note_lookup(hit):
+    """
+    Notes a cache lookup of the location of a file for the recorded call.
+    """
+    call = getattr(_state, 'call', None)
+    if call is not None:
+        call['cache_hits' if hit else 'cache_misses'] += 1
+
+
+def note_backend(storage, backend):
+    """
+    Notes the storage backend used by the recorded call.
+    """
+    call = getattr(_state, 'call', None)
+    if call is not None:
+        call['backend'] = '%s (%s)' % (
+            'local' if backend is storage.local else 'remote',
+            backend.__class__.__name__)
+
+
+class ProfilerMiddleware(MiddlewareMixin):
+    """
+    Records the storage calls made while handling each request, see
+    :mod:`queued_storage.profiling`.
+    """
+    def process_request(self, request):
+        request.queued_storage_profile = start()
+
+    def process_response(self, request, response):
+        profile = stop()
+        if profile is None:
+            return response
+        response['X-Queued-Storage-Calls'] = str(len(profile.calls))
+        response['X-Queued-Storage-Time'] = '%.6f' % profile.duration
+        for call in profile.calls:
+            logger.debug("%(method)s(%(name)r): %(cache_hits)d cache hits, "
+                         "%(cache_misses)d misses, %(backend)s, "
+                         "%(duration).6fs", call)
+        for method, count in profile.n_plus_one():
+            logger.warning("%s %s: QueuedStorage.%s was called for %d files "
+                           "with a cache lookup each, consider looking "
+                           "them up at once.", request.method,
+                           request.path, method, count)
+        return response
@@ -0,0 +1,16 @@
+"""
+The ``S3BotoStorage`` storage of the
+`django-storages <https://django-storages.readthedocs.io/>`_ app deleting
+files in batches (see :class:`~queued_storage.storages.S3BatchDeleteMixin`),
+the default remote storage of
+:class:`~queued_storage.backends.QueuedS3BotoStorage`.
+
+Requires django-storages and boto to be installed.
+"""
+from storages.backends import s3boto
+
+from .storages import S3BatchDeleteMixin
+
+
+class S3BotoStorage(S3BatchDeleteMixin, s3boto.S3BotoStorage):
+    pass
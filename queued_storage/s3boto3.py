@@ -0,0 +1,20 @@
+"""
+The ``S3Boto3Storage`` storage of the
+`django-storages <https://django-storages.readthedocs.io/>`_ app deleting
+files in batches (see :class:`~queued_storage.storages.S3BatchDeleteMixin`),
+e.g.:
+
+.. code-block:: python
+
+    QueuedFileSystemStorage(remote='queued_storage.s3boto3.S3Boto3Storage',
+                            queued_delete=True)
+
+Requires django-storages and boto3 to be installed.
+"""
+from storages.backends import s3boto3
+
+from .storages import S3BatchDeleteMixin
+
+
+class S3Boto3Storage(S3BatchDeleteMixin, s3boto3.S3Boto3Storage):
+    pass
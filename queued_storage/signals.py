@@ -24,11 +24,23 @@ the ``file_transferred`` signal::
     # Alternatively, you can also use the signal's connect method to connect:
     file_transferred.connect(log_file_transferred)
 
+The ``content_encoding`` argument is the encoding the file was compressed
+with while transferring it (``'gzip'`` or ``'zstd'``, see
+:attr:`~queued_storage.conf.settings.QUEUED_STORAGE_COMPRESSION`), or
+``None``.
+
 Note that this signal does **NOT** have access to the calling Model or even
 the FileField instance that it relates to, only the name of the file.
 As a result, this signal is somewhat limited and may only be of use if you
 have a very specific usage of django-queued-storage.
+
+The ``transfer_contended`` signal is sent with the name of a file whenever
+its transfer is postponed because another worker is transferring it at the
+same time, e.g. to count lease contention in your metrics.
 """
 from django.dispatch import Signal
 
-file_transferred = Signal(providing_args=["name", "local", "remote"])
+file_transferred = Signal(providing_args=["name", "local", "remote",
+                                           "content_encoding"])
+
+transfer_contended = Signal(providing_args=["name"])
@@ -0,0 +1,417 @@
+"""
+Storage backends used by django-queued-storage.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import six
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.utils._os import safe_join
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import force_bytes
+
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicatedStorage(Storage):
+    """
+    A storage combining multiple storage backends, used by the
+    :class:`~queued_storage.tasks.Transfer` task as the remote storage when
+    a :class:`~queued_storage.backends.QueuedStorage` has multiple remotes.
+
+    Saving a file reads its content only once and uploads it to all storages
+    (or only the given pending ones) in parallel threads, recording which
+    uploads succeeded. All other methods use the first storage, except
+    :meth:`~queued_storage.storages.ReplicatedStorage.exists` which requires
+    the file to exist in all of them.
+
+    :param storages: storage backend instances
+    :type storages: list
+    :param pending: indexes of the storages to save files to (default: all)
+    :type pending: list
+    """
+    def __init__(self, storages, pending=None):
+        self.storages = list(storages)
+        if pending is None:
+            pending = range(len(self.storages))
+        self.pending = list(pending)
+        #: The indexes of the storages the file was saved to
+        self.saved = []
+        #: The indexes of the storages the file couldn't be saved to
+        self.failed = []
+
+    def _get_content_path(self, content):
+        path = getattr(getattr(content, 'file', content), 'name', None)
+        if isinstance(path, six.string_types) and os.path.isfile(path):
+            return path
+        return None
+
+    def save(self, name, content, max_length=None):
+        path = self._get_content_path(content)
+        temp_path = None
+        if path is None:
+            # read the content only once, into a temporary file
+            fd, temp_path = tempfile.mkstemp()
+            with os.fdopen(fd, 'wb') as temp_file:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                shutil.copyfileobj(content, temp_file)
+            path = temp_path
+
+        lock = threading.Lock()
+
+        def upload(index):
+            try:
+                with open(path, 'rb') as source:
+                    self.storages[index].save(name, File(source, name=name))
+            except Exception as e:
+                logger.error("Unable to save '%s' to storage %d." %
+                             (name, index))
+                logger.exception(e)
+                with lock:
+                    self.failed.append(index)
+            else:
+                with lock:
+                    self.saved.append(index)
+
+        threads = [threading.Thread(target=upload, args=(index,))
+                   for index in self.pending]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if temp_path is not None:
+                os.remove(temp_path)
+        if self.failed:
+            raise IOError("Unable to save '%s' to %d of %d storages." %
+                          (name, len(self.failed), len(self.pending)))
+        return name
+
+    def delete(self, name):
+        for storage in self.storages:
+            storage.delete(name)
+
+    def exists(self, name):
+        return all(storage.exists(name) for storage in self.storages)
+
+    def _open(self, name, mode='rb'):
+        return self.storages[0].open(name, mode)
+
+    def listdir(self, path):
+        return self.storages[0].listdir(path)
+
+    def size(self, name):
+        return self.storages[0].size(name)
+
+    def url(self, name):
+        return self.storages[0].url(name)
+
+
+@deconstructible
+class ShardedFileSystemStorage(FileSystemStorage):
+    """
+    A :class:`~django:django.core.files.storage.FileSystemStorage` spreading
+    files across multiple directories, e.g. on different disks, to be used
+    as the local storage of a
+    :class:`~queued_storage.backends.QueuedStorage`:
+
+    .. code-block:: python
+
+        from queued_storage.backends import QueuedS3BotoStorage
+
+        sharded_s3storage = QueuedS3BotoStorage(
+            local='queued_storage.storages.ShardedFileSystemStorage',
+            local_options={'locations': ['/mnt/disk1', '/mnt/disk2']})
+
+    The directory of a file is determined by rendezvous hashing of its name,
+    so no lookup table is needed and adding a directory only moves the
+    files which hash to the new one.
+
+    :param locations: the directories to spread the files across
+    :type locations: list
+    """
+    def __init__(self, locations=None, base_url=None,
+                 file_permissions_mode=None, directory_permissions_mode=None):
+        if not locations:
+            raise ImproperlyConfigured("The ShardedFileSystemStorage "
+                                       "requires a list of locations.")
+        self.locations = [os.path.abspath(location) for location in locations]
+        self._location_keys = [force_bytes(location) + b'\0'
+                               for location in self.locations]
+        super(ShardedFileSystemStorage, self).__init__(
+            location=self.locations[0], base_url=base_url,
+            file_permissions_mode=file_permissions_mode,
+            directory_permissions_mode=directory_permissions_mode)
+
+    def get_location(self, name):
+        """
+        Returns the directory of the file with the given name.
+
+        :param name: file name
+        :type name: str
+        :rtype: str
+        """
+        name = force_bytes(name)
+        weights = [hashlib.md5(key + name).digest()
+                   for key in self._location_keys]
+        return self.locations[weights.index(max(weights))]
+
+    def path(self, name):
+        return safe_join(self.get_location(name), name)
+
+    def listdir(self, path):
+        directories, files = set(), set()
+        for location in self.locations:
+            directory = safe_join(location, path)
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.listdir(directory):
+                if os.path.isdir(os.path.join(directory, entry)):
+                    directories.add(entry)
+                else:
+                    files.add(entry)
+        return sorted(directories), sorted(files)
+
+
+@deconstructible
+class MemoryStagingStorage(FileSystemStorage):
+    """
+    A :class:`~django:django.core.files.storage.FileSystemStorage` keeping
+    small files in a cache instead of writing them to the disk, to be used
+    as the local storage of a
+    :class:`~queued_storage.backends.QueuedStorage` so that saving and
+    transferring small files doesn't touch the file system:
+
+    .. code-block:: python
+
+        from queued_storage.backends import QueuedS3BotoStorage
+
+        staged_s3storage = QueuedS3BotoStorage(
+            local='queued_storage.storages.MemoryStagingStorage',
+            local_options={'location': '/mnt/staging',
+                           'cache_alias': 'staging'})
+
+    Files larger than ``max_memory_size``, or which the cache refuses to
+    store, are spilled to the disk. Files are deleted from the storage once
+    transferred to the remote storage (see
+    :attr:`~queued_storage.storages.MemoryStagingStorage.staging`), and
+    files kept in the cache can't be served with
+    :meth:`~queued_storage.storages.MemoryStagingStorage.url` or listed
+    with ``listdir``.
+
+    The cache is shared with the transfer workers and mustn't evict the
+    files before they're transferred, so it has to be a cache of its own,
+    shared between the web and worker processes, which refuses writes
+    instead of evicting entries when full (e.g. Redis with the
+    ``noeviction`` policy) and so bounds the memory used for staging. The
+    local-memory and dummy cache backends raise
+    :exc:`~django:django.core.exceptions.ImproperlyConfigured`.
+
+    :param max_memory_size: the maximum size in bytes of the files to keep
+                            in the cache (default: see
+                            :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_STAGING_MAX_MEMORY_SIZE`)
+    :type max_memory_size: int
+    :param cache_alias: the alias of the cache to keep the files in
+                        (default: see
+                        :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_STAGING_CACHE`)
+    :type cache_alias: str
+    """
+    #: Whether files are deleted from the storage once transferred to the
+    #: remote storage, see :meth:`~queued_storage.tasks.Transfer.run`.
+    staging = True
+
+    def __init__(self, max_memory_size=None, cache_alias=None, **kwargs):
+        if max_memory_size is None:
+            max_memory_size = settings.QUEUED_STORAGE_STAGING_MAX_MEMORY_SIZE
+        self.max_memory_size = max_memory_size
+        self.cache_alias = cache_alias or settings.QUEUED_STORAGE_STAGING_CACHE
+        if not self.cache_alias:
+            raise ImproperlyConfigured(
+                "The MemoryStagingStorage requires a cache alias, see the "
+                "QUEUED_STORAGE_STAGING_CACHE setting.")
+        if isinstance(self.cache, (LocMemCache, DummyCache)):
+            raise ImproperlyConfigured(
+                "The '%s' cache of the MemoryStagingStorage isn't shared "
+                "with the Celery workers." % self.cache_alias)
+        super(MemoryStagingStorage, self).__init__(**kwargs)
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get_cache_key(self, name):
+        """
+        Returns the cache key of the file with the given name.
+
+        :param name: file name
+        :type name: str
+        :rtype: str
+        """
+        key = force_bytes(self.location) + b'\0' + force_bytes(name)
+        return '%s_staging_%s' % (settings.QUEUED_STORAGE_CACHE_PREFIX,
+                                  hashlib.md5(key).hexdigest())
+
+    def _get_staged(self, name):
+        # a tuple of the content and the time it was saved at, or None
+        return self.cache.get(self.get_cache_key(name))
+
+    def _save(self, name, content):
+        if content.size <= self.max_memory_size:
+            data = b''.join(force_bytes(chunk) for chunk in content.chunks())
+            try:
+                # fails if the name got taken meantime
+                staged = self.cache.add(self.get_cache_key(name),
+                                        (data, time.time()), None)
+            except Exception as e:
+                # e.g. the cache is full
+                logger.warning("Unable to stage '%s' in the '%s' cache, "
+                               "writing it to the disk: %s" %
+                               (name, self.cache_alias, e))
+                staged = False
+            if staged:
+                return name
+        return super(MemoryStagingStorage, self)._save(name, content)
+
+    def _open(self, name, mode='rb'):
+        staged = self._get_staged(name)
+        if staged is None:
+            return super(MemoryStagingStorage, self)._open(name, mode)
+        return ContentFile(staged[0], name=name)
+
+    def delete(self, name):
+        staged = self._get_staged(name)
+        if staged is None:
+            return super(MemoryStagingStorage, self).delete(name)
+        self.cache.delete(self.get_cache_key(name))
+
+    def exists(self, name):
+        return (self._get_staged(name) is not None or
+                super(MemoryStagingStorage, self).exists(name))
+
+    def path(self, name):
+        if self._get_staged(name) is not None:
+            raise NotImplementedError("The file '%s' is staged in memory." %
+                                      name)
+        return super(MemoryStagingStorage, self).path(name)
+
+    def size(self, name):
+        staged = self._get_staged(name)
+        if staged is None:
+            return super(MemoryStagingStorage, self).size(name)
+        return len(staged[0])
+
+    def _staged_time(self, name, method, naive=False):
+        staged = self._get_staged(name)
+        if staged is None:
+            return getattr(super(MemoryStagingStorage, self), method)(name)
+        if naive:
+            # the deprecated methods of Django < 2.0
+            return datetime.fromtimestamp(staged[1])
+        return self._datetime_from_timestamp(staged[1])
+
+    def accessed_time(self, name):
+        return self._staged_time(name, 'accessed_time', naive=True)
+
+    def created_time(self, name):
+        return self._staged_time(name, 'created_time', naive=True)
+
+    def modified_time(self, name):
+        return self._staged_time(name, 'modified_time', naive=True)
+
+    def get_accessed_time(self, name):
+        return self._staged_time(name, 'get_accessed_time')
+
+    def get_created_time(self, name):
+        return self._staged_time(name, 'get_created_time')
+
+    def get_modified_time(self, name):
+        return self._staged_time(name, 'get_modified_time')
+
+
+@deconstructible
+class LatencyFileSystemStorage(FileSystemStorage):
+    """
+    A :class:`~django:django.core.files.storage.FileSystemStorage` waiting
+    the given number of seconds before saving and opening files, to stand
+    in for a remote storage in load tests (see the
+    ``queued_storage_loadtest`` management command).
+
+    :param latency: the number of seconds to wait
+    :type latency: float
+    """
+    def __init__(self, latency=0, **kwargs):
+        self.latency = latency
+        super(LatencyFileSystemStorage, self).__init__(**kwargs)
+
+    def _save(self, name, content):
+        time.sleep(self.latency)
+        return super(LatencyFileSystemStorage, self)._save(name, content)
+
+    def _open(self, name, mode='rb'):
+        time.sleep(self.latency)
+        return super(LatencyFileSystemStorage, self)._open(name, mode)
+
+
+class S3BatchDeleteMixin(object):
+    """
+    A mixin for the S3 storages of the
+    `django-storages <https://django-storages.readthedocs.io/>`_ app
+    (``S3BotoStorage`` and ``S3Boto3Storage``), adding a ``delete_many``
+    method which deletes files with the bulk delete API of S3, up to 1000
+    files per request, so the :class:`~queued_storage.tasks.Delete` task
+    deletes them in batches (see :mod:`queued_storage.s3boto` and
+    :mod:`queued_storage.s3boto3`).
+    """
+    #: The maximum number of files S3 deletes with one request.
+    max_delete_keys = 1000
+
+    def _get_delete_key(self, name):
+        name = self._normalize_name(self._clean_name(name))
+        if hasattr(self, '_encode_name'):
+            name = self._encode_name(name)
+        return name
+
+    def delete_many(self, names):
+        """
+        Deletes the files with the given names, raising an
+        :exc:`~python:IOError` if S3 couldn't delete some of them.
+
+        :param names: file names
+        :type names: list
+        """
+        keys = [self._get_delete_key(name) for name in names]
+        errors = []
+        for start in range(0, len(keys), self.max_delete_keys):
+            batch = keys[start:start + self.max_delete_keys]
+            if hasattr(self.bucket, 'delete_objects'):
+                # a boto3 Bucket resource
+                response = self.bucket.delete_objects(Delete={
+                    'Objects': [{'Key': key} for key in batch],
+                    'Quiet': True,
+                })
+                errors.extend((error['Key'], error.get('Message'))
+                              for error in response.get('Errors', []))
+            else:
+                result = self.bucket.delete_keys(batch, quiet=True)
+                errors.extend((error.key, error.message)
+                              for error in result.errors)
+        if errors:
+            raise IOError("Unable to delete %d files from S3: %s" % (
+                len(errors), ', '.join('%s (%s)' % error
+                                       for error in errors[:10])))
@@ -1,5 +1,14 @@
+import errno
+import hashlib
+import os
+import uuid
+
 from django.core.cache import cache
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.encoding import force_bytes
 
+from celery.signals import worker_process_init
 from celery.task import Task
 try:
     from celery.utils.log import get_task_logger
@@ -7,13 +16,44 @@ except ImportError:
     from celery.log import get_task_logger
 
 
+from .compression import (compress, decompress, get_compressed_name,
+                          should_compress)
 from .conf import settings
-from .signals import file_transferred
-from .utils import import_attribute
+from .lru import evict
+from .signals import file_transferred, transfer_contended
+from .storages import ReplicatedStorage, ShardedFileSystemStorage
+from .utils import (Backlog, Lease, copy_file, get_backend,
+                    get_backend_pool, get_file_metadata, is_transferred,
+                    remove_partial_files)
 
 logger = get_task_logger(name=__name__)
 
 
+@worker_process_init.connect
+def warm_up_worker(**kwargs):
+    """
+    Creates the storage backends and connects to the remote storages when
+    a worker process starts, see
+    :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_WARM_UP`.
+    """
+    if settings.QUEUED_STORAGE_WARM_UP:
+        from .backends import warm_up
+        warm_up()
+
+
+def _backend_configs(paths, options):
+    if isinstance(paths, (list, tuple)):
+        return list(zip(paths, options))
+    return [(paths, options)]
+
+
+class TransferContended(Exception):
+    """
+    Raised by :meth:`Transfer.attempt` if another worker holds the lease on
+    the file.
+    """
+
+
 class Transfer(Task):
     """
     The default task. Transfers a file to a remote location.
@@ -60,6 +100,58 @@ class Transfer(Task):
     #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_RETRY_DELAY`)
     default_retry_delay = settings.QUEUED_STORAGE_RETRY_DELAY
 
+    #: Whether files are transferred between two
+    #: :class:`~django:django.core.files.storage.FileSystemStorage` backends
+    #: without copying their content through Python, see
+    #: :meth:`~queued_storage.tasks.Transfer.transfer_file`.
+    fast_transfer = True
+
+    #: The storage classes files are transferred between on the file
+    #: system, see :meth:`~queued_storage.tasks.Transfer.transfer_file`.
+    fast_transfer_storages = (FileSystemStorage, ShardedFileSystemStorage)
+
+    #: The content encoding to compress files with, ``'gzip'`` or
+    #: ``'zstd'`` (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_COMPRESSION`)
+    compression = settings.QUEUED_STORAGE_COMPRESSION
+
+    #: The content types of the files to compress (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_COMPRESSION_CONTENT_TYPES`)
+    compression_content_types = settings.QUEUED_STORAGE_COMPRESSION_CONTENT_TYPES
+
+    #: The minimum size in bytes of the files to compress (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_COMPRESSION_MIN_SIZE`)
+    compression_min_size = settings.QUEUED_STORAGE_COMPRESSION_MIN_SIZE
+
+    #: The number of seconds the lease on a file expires after if the
+    #: worker transferring it dies, ``None`` to not lease files (default:
+    #: see :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_TRANSFER_LEASE_TIMEOUT`)
+    lease_timeout = settings.QUEUED_STORAGE_TRANSFER_LEASE_TIMEOUT
+
+    #: Whether copies by :meth:`~queued_storage.tasks.Transfer.transfer_file`
+    #: which failed are continued where they stopped when retried, instead
+    #: of starting over.
+    resume_transfers = True
+
+    #: The number of seconds after which partial copies which weren't
+    #: continued are removed from the remote storage, ``None`` to keep
+    #: them (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_PARTIAL_TRANSFER_MAX_AGE`)
+    partial_transfer_max_age = settings.QUEUED_STORAGE_PARTIAL_TRANSFER_MAX_AGE
+
+    #: The maximum number of instances of each remote storage backend used
+    #: at once by a worker process, each with its own connections, or
+    #: ``None`` to share a single instance (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKEND_POOL_SIZE`)
+    pool_size = settings.QUEUED_STORAGE_BACKEND_POOL_SIZE
+
+    #: The hash algorithm to compute the checksums of transferred files
+    #: with, recorded in their metadata (see
+    #: :meth:`~queued_storage.backends.QueuedStorage.get_metadata`), e.g.
+    #: ``'md5'``. Reads each file once more after transferring it, so
+    #: ``None`` by default to skip it.
+    metadata_checksum = None
+
     def run(self, name, cache_key,
             local_path, remote_path,
             local_options, remote_options, **kwargs):
@@ -68,38 +160,244 @@ class Transfer(Task):
         method with the local and remote storage backends as given
         with the parameters.
 
+        If lists of remote storage classes and options are given, the file
+        is transferred to all of them using a
+        :class:`~queued_storage.storages.ReplicatedStorage`, and only the
+        ones which failed are retried.
+
+        Only one worker at a time transfers a file, holding a lease on it
+        (see :attr:`~queued_storage.tasks.Transfer.lease_timeout`). Other
+        workers postpone the transfer by retrying it, and skip it then if
+        the file was transferred in the meantime. Each postponement sends
+        the :data:`~queued_storage.signals.transfer_contended` signal, and
+        doesn't count against
+        :attr:`~queued_storage.tasks.Transfer.max_retries`.
+
+        Transferred files are deleted from local storages which only stage
+        them, see :attr:`~queued_storage.storages.MemoryStagingStorage.staging`.
+
         :param name: name of the file to transfer
         :type name: str
-        :param local_path: local storage class to transfer from
+        :param local_path: local storage class or alias to transfer from
         :type local_path: str
         :param local_options: options of the local storage class
         :type local_options: dict
-        :param remote_path: remote storage class to transfer to
+        :param remote_path: remote storage class or alias to transfer to
+                            (or a list of them)
         :type remote_path: str
         :param remote_options: options of the remote storage class
+                               (or a list of them)
         :type remote_options: dict
         :param cache_key: cache key to set after a successful transfer
         :type cache_key: str
         :rtype: task result
         """
-        local = import_attribute(local_path)(**local_options)
-        remote = import_attribute(remote_path)(**remote_options)
-        result = self.transfer(name, local, remote, **kwargs)
-
-        if result is True:
-            cache.set(cache_key, True)
-            file_transferred.send(sender=self.__class__,
-                                  name=name, local=local, remote=remote)
-        elif result is False:
-            args = [name, cache_key, local_path,
-                    remote_path, local_options, remote_options]
-            self.retry(args=args, kwargs=kwargs)
-        else:
+        args = [name, cache_key, local_path,
+                remote_path, local_options, remote_options]
+        postponed = kwargs.pop('postponed', False)
+        postponements = kwargs.pop('postponements', 0)
+        try:
+            result = self.attempt(name, cache_key, local_path, remote_path,
+                                  local_options, remote_options, kwargs,
+                                  postponed=postponed)
+        except TransferContended:
+            logger.info("Postponing transfer of '%s' in progress "
+                        "elsewhere", name)
+            transfer_contended.send(sender=self.__class__, name=name)
+            kwargs.update(postponed=True, postponements=postponements + 1)
+            # always allowed, None would mean the default max_retries
+            self.retry(args=args, kwargs=kwargs,
+                       max_retries=self.request.retries + 1)
+        if result is False:
+            max_retries = self.max_retries
+            if postponements:
+                # Celery counts the postponements as retries as well
+                kwargs['postponements'] = postponements
+                if max_retries is not None:
+                    max_retries += postponements
+            self.retry(args=args, kwargs=kwargs, max_retries=max_retries)
+        elif result is not True:
             raise ValueError("Task '%s' did not return True/False but %s" %
                              (self.__class__, result))
         return result
 
-    def transfer(self, name, local, remote, **kwargs):
+    def attempt(self, name, cache_key, local_path, remote_path,
+                local_options, remote_options, kwargs, postponed=False):
+        """
+        Transfers the file once, without retrying the task, holding the
+        lease on it. Used by :meth:`~queued_storage.tasks.Transfer.run`
+        and to upload files right away when saving them (see
+        :meth:`~queued_storage.backends.QueuedStorage.transfer_inline`).
+
+        :param kwargs: the keyword arguments of the task, updated with the
+                       state to retry the transfer with
+        :type kwargs: dict
+        :param postponed: whether the transfer was postponed before, to
+                          skip it if the file was transferred meanwhile
+        :type postponed: bool
+        :returns: the result of the transfer
+        :raises: :class:`~queued_storage.tasks.TransferContended` if another
+                 worker is transferring the file at the moment
+        """
+        lease = None
+        if self.lease_timeout:
+            lease = Lease('%s_lease' % cache_key, self.lease_timeout)
+            if not lease.acquire():
+                raise TransferContended(name)
+        try:
+            if postponed and is_transferred(cache.get(cache_key)):
+                # transferred by the worker it was postponed for
+                return True
+            local = get_backend(local_path, local_options)
+            remotes = self.acquire_remotes(remote_path, remote_options)
+            result = None
+            try:
+                result = self._run(name, cache_key, local, remotes,
+                                   isinstance(remote_path, (list, tuple)),
+                                   kwargs)
+            finally:
+                self.release_remotes(remote_path, remote_options, remotes,
+                                     healthy=result is True)
+            if result is True:
+                Backlog(local).remove(cache_key)
+                if getattr(local, 'staging', False):
+                    # e.g. MemoryStagingStorage
+                    local.delete(name)
+            return result
+        finally:
+            if lease is not None:
+                lease.release()
+
+    def _run(self, name, cache_key, local, remotes, replicated, kwargs):
+        if replicated:
+            remote = ReplicatedStorage(remotes,
+                                       pending=kwargs.pop('pending', None))
+        else:
+            remote, remotes = remotes[0], None
+        content_encoding = self.get_content_encoding(name, local)
+        # before transferring, the local file may be moved
+        metadata = self.get_metadata(name, local)
+        if content_encoding:
+            result = self.transfer(name, local, remote,
+                                   content_encoding=content_encoding, **kwargs)
+        else:
+            result = self.transfer(name, local, remote, **kwargs)
+
+        if (result in (True, False) and
+                cache.get('%s_deleted' % cache_key) is not None):
+            # deleted in the meantime, the delete task removes the copies
+            # once the lease is released, see QueuedStorage.delete_many
+            logger.info("Not recording the transfer of '%s' deleted "
+                        "meanwhile." % name)
+            return True
+        if remotes is not None and result in (True, False):
+            # track the location in each of the remote storages and only
+            # retry the ones the file couldn't be saved to
+            if result:
+                failed = []
+            elif remote.saved:
+                failed = remote.failed
+            else:
+                failed = remote.pending
+            state = content_encoding or True
+            cache_result = tuple(False if index in failed else state
+                                 for index in range(len(remotes)))
+            if any(cache_result):
+                cache.set_many({cache_key: cache_result,
+                                '%s_metadata' % cache_key: metadata})
+            for index in remote.saved:
+                file_transferred.send(sender=self.__class__, name=name,
+                                      local=local, remote=remotes[index],
+                                      content_encoding=content_encoding)
+            kwargs['pending'] = failed
+        elif result is True:
+            cache.set_many({cache_key: content_encoding or True,
+                            '%s_metadata' % cache_key: metadata})
+            file_transferred.send(sender=self.__class__,
+                                  name=name, local=local, remote=remote,
+                                  content_encoding=content_encoding)
+        return result
+
+    def acquire_remotes(self, remote_path, remote_options):
+        """
+        Returns the instances of the given remote storage backends to
+        transfer a file with, the ones shared per process or, if
+        :attr:`~queued_storage.tasks.Transfer.pool_size` is set, ones
+        acquired from the backends' pools (see
+        :class:`~queued_storage.utils.BackendPool`).
+
+        :param remote_path: remote storage class or alias (or a list of them)
+        :param remote_options: options of the remote storage class
+                               (or a list of them)
+        :rtype: list
+        """
+        remotes = []
+        try:
+            for path, options in _backend_configs(remote_path,
+                                                  remote_options):
+                if self.pool_size:
+                    pool = get_backend_pool(path, options, self.pool_size)
+                    remotes.append(pool.acquire())
+                else:
+                    remotes.append(get_backend(path, options))
+        except Exception:
+            self.release_remotes(remote_path, remote_options, remotes,
+                                 healthy=True)
+            raise
+        return remotes
+
+    def release_remotes(self, remote_path, remote_options, remotes,
+                        healthy=True):
+        """
+        Gives back the instances of the given remote storage backends
+        returned by :meth:`~queued_storage.tasks.Transfer.acquire_remotes`
+        to their pools, which replace them with new ones if unhealthy.
+        """
+        if not self.pool_size:
+            return
+        configs = _backend_configs(remote_path, remote_options)
+        for (path, options), remote in zip(configs, remotes):
+            get_backend_pool(path, options, self.pool_size).release(
+                remote, healthy)
+
+    def get_metadata(self, name, local):
+        """
+        Returns the metadata of the file with the given name to record
+        after transferring it, see
+        :func:`~queued_storage.utils.get_file_metadata`.
+
+        :param name: The name of the file to transfer
+        :param local: The local storage backend instance
+        :rtype: dict or ``None``
+        """
+        try:
+            return get_file_metadata(local, name, self.metadata_checksum)
+        except Exception:
+            # the transfer will fail (and be retried) anyway
+            return None
+
+    def get_content_encoding(self, name, local):
+        """
+        Returns the content encoding to compress the file with the given
+        name with, if any, depending on its content type and size.
+
+        :param name: The name of the file to transfer
+        :param local: The local storage backend instance
+        :rtype: str or ``None``
+        """
+        if not self.compression:
+            return None
+        try:
+            size = local.size(name)
+        except Exception:
+            # the transfer will fail (and be retried) anyway
+            return None
+        if should_compress(name, size, self.compression_content_types,
+                           self.compression_min_size):
+            return self.compression
+        return None
+
+    def transfer(self, name, local, remote, content_encoding=None, **kwargs):
         """
         Transfers the file with the given name from the local to the remote
         storage backend.
@@ -107,12 +405,30 @@ class Transfer(Task):
         :param name: The name of the file to transfer
         :param local: The local storage backend instance
         :param remote: The remote storage backend instance
+        :param content_encoding: The content encoding to compress the file
+                                 with while transferring it, if any
         :returns: `True` when the transfer succeeded, `False` if not. Retries
                   the task when returning `False`
         :rtype: bool
         """
         try:
-            remote.save(name, local.open(name))
+            if content_encoding:
+                stored_name = get_compressed_name(name, content_encoding)
+                saved = remote.save(stored_name,
+                                    compress(local.open(name),
+                                             content_encoding))
+            elif self.transfer_file(name, local, remote):
+                return True
+            else:
+                stored_name = name
+                saved = remote.save(name, local.open(name))
+            if saved != stored_name:
+                # the name got taken on the remote storage meanwhile,
+                # remove the copy saved under another name
+                remote.delete(saved)
+                logger.error("Unable to save '%s' to remote storage, "
+                             "the name is taken. About to retry." % name)
+                return False
             return True
         except Exception as e:
             logger.error("Unable to save '%s' to remote storage. "
@@ -120,6 +436,77 @@ class Transfer(Task):
             logger.exception(e)
             return False
 
+    def transfer_file(self, name, local, remote, move=False):
+        """
+        Transfers the file with the given name directly on the file system
+        if both the local and the remote storage backend are
+        :class:`~django:django.core.files.storage.FileSystemStorage`
+        instances (e.g. a local disk and a NFS mount), using an in-kernel
+        copy (or a hardlink when moving), see
+        :func:`~queued_storage.utils.copy_file`. Subclasses overriding how
+        files are saved are excluded, except the ones in
+        :attr:`~queued_storage.tasks.Transfer.fast_transfer_storages`.
+        Failed copies are resumed when retried (see
+        :attr:`~queued_storage.tasks.Transfer.resume_transfers`).
+
+        :param name: The name of the file to transfer
+        :param local: The local storage backend instance
+        :param remote: The remote storage backend instance
+        :param move: Whether to move the file instead of copying it
+        :returns: `True` if the file was transferred, `False` if it needs
+                  to be transferred using the storage API instead
+        :rtype: bool
+        """
+        if not (self.fast_transfer and
+                local.__class__ in self.fast_transfer_storages and
+                remote.__class__ in self.fast_transfer_storages):
+            return False
+        try:
+            source = local.path(name)
+        except NotImplementedError:
+            # e.g. staged in memory, see MemoryStagingStorage
+            return False
+        self.remove_partial_files(remote, name)
+        try:
+            copy_file(source, remote.path(name), move=move,
+                      file_permissions_mode=remote.file_permissions_mode,
+                      directory_permissions_mode=remote.directory_permissions_mode,
+                      resume=self.resume_transfers)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # leave picking an available name to the remote storage
+            return False
+        return True
+
+    def remove_partial_files(self, remote, name):
+        """
+        Removes the partial copies older than
+        :attr:`~queued_storage.tasks.Transfer.partial_transfer_max_age`
+        from the directory of the file with the given name in the given
+        remote file system storage, at most once per that age and
+        directory.
+
+        :param remote: The remote storage backend instance
+        :param name: The name of the file to transfer
+        :returns: the paths of the removed files
+        :rtype: list
+        """
+        if not self.partial_transfer_max_age:
+            return []
+        directory = os.path.dirname(remote.path(name))
+        lock_key = '%s_partials_%s' % (
+            settings.QUEUED_STORAGE_CACHE_PREFIX,
+            hashlib.md5(force_bytes(directory)).hexdigest())
+        if not cache.add(lock_key, True, self.partial_transfer_max_age):
+            return []
+        removed = remove_partial_files(directory,
+                                       self.partial_transfer_max_age)
+        if removed:
+            logger.info("Removed %d stale partial files from the remote "
+                        "storage." % len(removed))
+        return removed
+
 
 class TransferAndDelete(Transfer):
     """
@@ -127,9 +514,325 @@ class TransferAndDelete(Transfer):
     file with the given name using the local storage if the transfer
     was successful.
     """
+    def transfer_file(self, name, local, remote, move=True):
+        return super(TransferAndDelete, self).transfer_file(name, local,
+                                                            remote, move=move)
+
     def transfer(self, name, local, remote, **kwargs):
         result = super(TransferAndDelete, self).transfer(name, local,
                                                          remote, **kwargs)
         if result:
             local.delete(name)
         return result
+
+
+class LocalCacheMixin(object):
+    """
+    A mixin for tasks using the local storage as a cache of remote files,
+    which deletes the least recently used local files when the local
+    storage exceeds
+    :attr:`~queued_storage.tasks.LocalCacheMixin.max_bytes` or
+    :attr:`~queued_storage.tasks.LocalCacheMixin.max_files`.
+    """
+    #: The maximum total size of the local files in bytes (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_LOCAL_CACHE_MAX_BYTES`)
+    max_bytes = settings.QUEUED_STORAGE_LOCAL_CACHE_MAX_BYTES
+
+    #: The maximum number of local files (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_LOCAL_CACHE_MAX_FILES`)
+    max_files = settings.QUEUED_STORAGE_LOCAL_CACHE_MAX_FILES
+
+    #: The minimum number of seconds between two evictions from the same
+    #: local storage (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_LOCAL_CACHE_EVICTION_INTERVAL`)
+    eviction_interval = settings.QUEUED_STORAGE_LOCAL_CACHE_EVICTION_INTERVAL
+
+    def evict(self, local, remote):
+        """
+        Deletes the least recently used local files which exceed the
+        quotas, at most once per
+        :attr:`~queued_storage.tasks.LocalCacheMixin.eviction_interval`.
+
+        :param local: The local storage backend instance
+        :param remote: The remote storage backend instance
+        :returns: the names of the deleted files
+        :rtype: list
+        """
+        if self.eviction_interval:
+            location = getattr(local, 'location', repr(local))
+            lock_key = '%s_eviction_%s' % (
+                settings.QUEUED_STORAGE_CACHE_PREFIX,
+                hashlib.md5(force_bytes(location)).hexdigest())
+            if not cache.add(lock_key, True, self.eviction_interval):
+                return []
+        evicted = evict(local, remote,
+                        max_bytes=self.max_bytes, max_files=self.max_files,
+                        encoding=self.compression)
+        if evicted:
+            logger.info("Evicted %d files from the local storage." %
+                        len(evicted))
+        return evicted
+
+
+class TransferAndCache(LocalCacheMixin, Transfer):
+    """
+    A :class:`~queued_storage.tasks.Transfer` subclass which keeps the local
+    copies of transferred files as a cache, deleting the least recently used
+    ones when the local storage exceeds its quotas (see
+    :class:`~queued_storage.tasks.LocalCacheMixin`).
+
+    Use it together with the
+    :attr:`~queued_storage.backends.QueuedStorage.prefer_local` option
+    to serve files from the local storage as long as they are cached:
+
+    .. code-block:: python
+
+        from queued_storage.backends import QueuedS3BotoStorage
+
+        s3_cached_storage = QueuedS3BotoStorage(
+            task='queued_storage.tasks.TransferAndCache',
+            prefer_local=True)
+    """
+    def transfer(self, name, local, remote, **kwargs):
+        result = super(TransferAndCache, self).transfer(name, local,
+                                                        remote, **kwargs)
+        if result:
+            self.evict(local, remote)
+        return result
+
+
+class Fetch(LocalCacheMixin, Task):
+    """
+    The task filling the local storage with a copy of a remote file when
+    it's opened with the
+    :attr:`~queued_storage.backends.QueuedStorage.read_through` option. It
+    isn't retried, the file is simply read from the remote storage until
+    another fetch succeeds.
+    """
+    #: The maximum size of the files to copy to the local storage in bytes
+    #: (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_READ_THROUGH_MAX_SIZE`)
+    max_size = settings.QUEUED_STORAGE_READ_THROUGH_MAX_SIZE
+
+    def run(self, name, cache_key,
+            local_path, remote_path,
+            local_options, remote_options, content_encoding=None, **kwargs):
+        """
+        Copies the file with the given name from the remote to the local
+        storage unless it's bigger than
+        :attr:`~queued_storage.tasks.Fetch.max_size`, and evicts the least
+        recently used local files if needed.
+
+        :param name: name of the file to fetch
+        :type name: str
+        :param cache_key: cache key of the file
+        :type cache_key: str
+        :param local_path: local storage class or alias to fetch to
+        :type local_path: str
+        :param remote_path: remote storage class or alias to fetch from
+        :type remote_path: str
+        :param local_options: options of the local storage class
+        :type local_options: dict
+        :param remote_options: options of the remote storage class
+        :type remote_options: dict
+        :param content_encoding: content encoding the file was compressed
+                                 with in the remote storage
+        :type content_encoding: str
+        :returns: whether the file is available locally
+        :rtype: bool
+        """
+        local = get_backend(local_path, local_options)
+        remote = get_backend(remote_path, remote_options)
+        too_large = False
+        try:
+            if local.exists(name):
+                return True
+            remote_name = get_compressed_name(name, content_encoding)
+            if (self.max_size is not None and
+                    remote.size(remote_name) > self.max_size):
+                too_large = True
+                return False
+            self.fetch(name, local, remote, content_encoding)
+            self.evict(local, remote)
+            return True
+        except Exception as e:
+            logger.error("Unable to fetch '%s' from remote storage." % name)
+            logger.exception(e)
+            return False
+        finally:
+            if too_large:
+                # opening the file doesn't queue another fetch (and ask
+                # the remote storage for its size) until the marker expires
+                cache.set('%s_fetch' % cache_key, False,
+                          settings.QUEUED_STORAGE_FETCH_TIMEOUT)
+            else:
+                cache.delete('%s_fetch' % cache_key)
+
+    def fetch(self, name, local, remote, content_encoding=None):
+        """
+        Copies the file with the given name from the remote to the local
+        storage backend.
+
+        :param name: The name of the file to fetch
+        :param local: The local storage backend instance
+        :param remote: The remote storage backend instance
+        :param content_encoding: The content encoding the file was
+                                 compressed with in the remote storage
+        """
+        if content_encoding:
+            remote_name = get_compressed_name(name, content_encoding)
+            content = File(decompress(remote.open(remote_name),
+                                      content_encoding), name=name)
+        elif (local.__class__ in Transfer.fast_transfer_storages and
+                remote.__class__ in Transfer.fast_transfer_storages):
+            copy_file(remote.path(name), local.path(name),
+                      file_permissions_mode=local.file_permissions_mode,
+                      directory_permissions_mode=local.directory_permissions_mode)
+            return
+        else:
+            content = remote.open(name)
+        saved_name = local.save(name, content)
+        if saved_name != name:
+            # fetched concurrently in the meantime
+            local.delete(saved_name)
+
+
+class Delete(Task):
+    """
+    The task deleting files from the remote storage, queued by
+    :meth:`~queued_storage.backends.QueuedStorage.delete_many`.
+
+    Files are deleted in batches of
+    :attr:`~queued_storage.tasks.Delete.batch_size` with the
+    ``delete_many`` method of the remote storage if it has one (e.g. the
+    S3 storages using :class:`~queued_storage.storages.S3BatchDeleteMixin`
+    or another subclass calling the batch delete API of a cloud storage),
+    otherwise one by one. Deleting files which don't exist (anymore)
+    succeeds, so the task can simply be retried with the files it couldn't
+    delete.
+
+    Each file is deleted holding the same lease as the transfer task (see
+    :attr:`~queued_storage.tasks.Delete.lease_timeout`), so a transfer in
+    progress finishes first, and only while it's still marked deleted,
+    i.e. not saved again meanwhile.
+    """
+    #: The number of retries if unsuccessful (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_RETRIES`)
+    max_retries = settings.QUEUED_STORAGE_RETRIES
+
+    #: The delay between each retry in seconds (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_RETRY_DELAY`)
+    default_retry_delay = settings.QUEUED_STORAGE_RETRY_DELAY
+
+    #: The maximum number of files to delete with one call of the remote
+    #: storage's ``delete_many`` method (default: see
+    #: :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_DELETE_BATCH_SIZE`)
+    batch_size = settings.QUEUED_STORAGE_DELETE_BATCH_SIZE
+
+    #: The number of seconds the leases on the files expire after if the
+    #: worker deleting them dies, ``None`` to not lease files (default:
+    #: see :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_TRANSFER_LEASE_TIMEOUT`)
+    lease_timeout = settings.QUEUED_STORAGE_TRANSFER_LEASE_TIMEOUT
+
+    def run(self, names, cache_keys, remote_path, remote_options, **kwargs):
+        """
+        Deletes the files with the given names from the given remote
+        storage, or all of the given remote storages, retrying the task
+        with the files which couldn't be deleted or were leased by a
+        transfer.
+
+        :param names: the names each file may be stored with in the
+                      remote storage, e.g. compressed, a list per file
+        :type names: list
+        :param cache_keys: the cache keys of the files
+        :type cache_keys: list
+        :param remote_path: remote storage class or alias to delete from
+                            (or a list of them)
+        :type remote_path: str
+        :param remote_options: options of the remote storage class
+                               (or a list of them)
+        :type remote_options: dict
+        :rtype: task result
+        """
+        configs = _backend_configs(remote_path, remote_options)
+        # the indexes of the files left to delete from each remote storage
+        pending = kwargs.pop('pending', None)
+        if pending is None:
+            pending = [list(range(len(names))) for config in configs]
+        token = uuid.uuid4().hex
+        leased = []
+        try:
+            for index in sorted(set().union(*pending)):
+                if (not self.lease_timeout or
+                        cache.add('%s_lease' % cache_keys[index], token,
+                                  self.lease_timeout)):
+                    leased.append(index)
+            # files saved again meanwhile aren't deleted anymore
+            deleted_keys = ['%s_deleted' % cache_keys[index]
+                            for index in leased]
+            marked = cache.get_many(deleted_keys)
+            skipped = set(index for index, key in zip(leased, deleted_keys)
+                          if key not in marked)
+            leased = [index for index in leased if index not in skipped]
+            for remote_index, (path, options) in enumerate(configs):
+                indexes = [index for index in pending[remote_index]
+                           if index in leased]
+                failed = self.delete(
+                    [name for index in indexes for name in names[index]],
+                    get_backend(path, options))
+                pending[remote_index] = [
+                    index for index in pending[remote_index]
+                    if index not in skipped and
+                    (index not in leased or
+                     any(name in failed for name in names[index]))]
+            done = [index for index in leased
+                    if not any(index in indexes for indexes in pending)]
+            # overriding the location of a transfer finished meanwhile
+            cache.set_many(dict((cache_keys[index], False)
+                                for index in done))
+            cache.delete_many(['%s_deleted' % cache_keys[index]
+                               for index in done])
+        finally:
+            if self.lease_timeout:
+                lease_keys = ['%s_lease' % cache_keys[index]
+                              for index in leased]
+                held = cache.get_many(lease_keys)
+                cache.delete_many([key for key in lease_keys
+                                   if held.get(key) == token])
+        if any(pending):
+            kwargs['pending'] = pending
+            self.retry(args=[names, cache_keys, remote_path, remote_options],
+                       kwargs=kwargs)
+        return True
+
+    def delete(self, names, remote):
+        """
+        Deletes the files with the given names from the given remote
+        storage backend.
+
+        :param names: The names of the files to delete
+        :param remote: The remote storage backend instance
+        :returns: the names of the files which couldn't be deleted
+        :rtype: list
+        """
+        failed = []
+        for start in range(0, len(names), self.batch_size):
+            batch = names[start:start + self.batch_size]
+            if hasattr(remote, 'delete_many'):
+                try:
+                    remote.delete_many(batch)
+                except Exception as e:
+                    logger.error("Unable to delete %d files from remote "
+                                 "storage. About to retry." % len(batch))
+                    logger.exception(e)
+                    failed.extend(batch)
+                continue
+            for name in batch:
+                try:
+                    remote.delete(name)
+                except Exception as e:
+                    logger.error("Unable to delete '%s' from remote storage. "
+                                 "About to retry." % name)
+                    logger.exception(e)
+                    failed.append(name)
+        return failed
@@ -1,6 +1,30 @@
+import errno
+import hashlib
+import mimetypes
+import os
+import shutil
+import threading
+import time
+import uuid
 from importlib import import_module
 
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_bytes
+
+from .conf import settings
+
+_backends = {}
+_backends_lock = threading.Lock()
+_pools = {}
+_executor = None
+
+#: The suffix of the files copies are written to until they're complete.
+PARTIAL_SUFFIX = '.queued-storage-partial'
+
+#: The number of bytes at the end of a partial copy compared with the
+#: source file before resuming the copy.
+RESUME_CHECK_SIZE = 64 * 1024
 
 
 def import_attribute(import_path=None, options=None):
@@ -23,3 +47,574 @@ def import_attribute(import_path=None, options=None):
             'Module "%s" does not define a "%s" class.' % (module, classname))
 
 
+def freeze(value):
+    """
+    Returns a hashable representation of the given (possibly nested)
+    storage options, e.g. to be used as a dictionary key.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item))
+                            for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, set):
+        return frozenset(freeze(item) for item in value)
+    return value
+
+
+def resolve_backend(import_path, options=None):
+    """
+    Returns the dotted import path and options of the storage backend
+    with the given import path or alias (see
+    :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKENDS`).
+    """
+    config = settings.QUEUED_STORAGE_BACKENDS.get(import_path)
+    if config is None:
+        return import_path, options or {}
+    if options:
+        raise ImproperlyConfigured("The storage alias '%s' can't be used "
+                                   "together with options." % import_path)
+    try:
+        return config['BACKEND'], config.get('OPTIONS') or {}
+    except KeyError:
+        raise ImproperlyConfigured("The storage alias '%s' doesn't define "
+                                   "a 'BACKEND'." % import_path)
+
+
+def get_backend(import_path, options=None):
+    """
+    Returns a storage backend instance for the given dotted import path
+    (or storage alias) and options. Instances are shared per process
+    between all callers passing the same path and options, so that e.g.
+    connection pools aren't duplicated.
+    """
+    import_path, options = resolve_backend(import_path, options)
+    try:
+        key = (import_path, freeze(options))
+        hash(key)
+    except TypeError:
+        # unhashable options, e.g. custom objects, can't be shared
+        return import_attribute(import_path)(**options)
+    backend = _backends.get(key)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(key)
+            if backend is None:
+                backend = import_attribute(import_path)(**options)
+                _backends[key] = backend
+    return backend
+
+
+def get_backend_pool(import_path, options=None, size=None):
+    """
+    Returns the :class:`~queued_storage.utils.BackendPool` of the storage
+    backend with the given dotted import path (or storage alias) and
+    options and size, shared per process like
+    :func:`~queued_storage.utils.get_backend` instances. The size
+    defaults to
+    :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_BACKEND_POOL_SIZE`.
+    """
+    import_path, options = resolve_backend(import_path, options)
+    size = size or settings.QUEUED_STORAGE_BACKEND_POOL_SIZE
+    try:
+        key = (import_path, freeze(options), size)
+        hash(key)
+    except TypeError:
+        # unhashable options, e.g. custom objects, can't be shared
+        return BackendPool(
+            import_path, options, size=size,
+            max_age=settings.QUEUED_STORAGE_BACKEND_POOL_MAX_AGE)
+    pool = _pools.get(key)
+    if pool is None:
+        with _backends_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = BackendPool(
+                    import_path, options, size=size,
+                    max_age=settings.QUEUED_STORAGE_BACKEND_POOL_MAX_AGE)
+                _pools[key] = pool
+    return pool
+
+
+class BackendPool(object):
+    """
+    A bounded pool of instances of the storage backend with the given dotted
+    import path (or storage alias) and options, so that several threads can
+    use a remote storage at once without sharing its connections. Acquiring
+    an instance blocks while all ``size`` instances are in use.
+
+    Instances are health checked when acquired: the ones released as
+    unhealthy (e.g. after a failed transfer) or created more than
+    ``max_age`` seconds ago are replaced by new instances, with new
+    connections and credentials.
+    """
+    def __init__(self, import_path, options=None, size=4, max_age=None):
+        self.import_path, self.options = resolve_backend(import_path, options)
+        self.size = size
+        self.max_age = max_age
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._created = {}
+
+    def acquire(self):
+        """
+        Returns an instance of the storage backend, which has to be given
+        back with :meth:`~queued_storage.utils.BackendPool.release`.
+        """
+        self._slots.acquire()
+        try:
+            with self._lock:
+                while self._idle:
+                    backend, created = self._idle.pop()
+                    if self.max_age is None or \
+                            time.time() - created < self.max_age:
+                        self._created[id(backend)] = created
+                        return backend
+            backend = import_attribute(self.import_path)(**self.options)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._created[id(backend)] = time.time()
+        return backend
+
+    def release(self, backend, healthy=True):
+        """
+        Gives back the given instance of the storage backend, to be reused
+        unless it's unhealthy. Instances acquired from another pool, e.g.
+        an unshared one, are dropped.
+        """
+        with self._lock:
+            created = self._created.pop(id(backend), None)
+            if created is None:
+                return
+            if healthy:
+                self._idle.append((backend, created))
+        self._slots.release()
+
+    def warm_up(self, probe):
+        """
+        Creates an instance of the storage backend and calls the given
+        function with it, e.g. to open its connections.
+        """
+        backend = self.acquire()
+        healthy = False
+        try:
+            probe(backend)
+            healthy = True
+        finally:
+            self.release(backend, healthy)
+
+
+def get_executor():
+    """
+    Returns the thread pool shared by all storages of the process to run
+    blocking storage operations in (see
+    :attr:`~queued_storage.conf.settings.QUEUED_STORAGE_THREAD_POOL_SIZE`).
+
+    :rtype: :class:`~concurrent.futures.ThreadPoolExecutor`
+    """
+    global _executor
+    if _executor is None:
+        # requires the futures backport on Python 2
+        from concurrent.futures import ThreadPoolExecutor
+        with _backends_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.QUEUED_STORAGE_THREAD_POOL_SIZE)
+    return _executor
+
+
+def is_transferred(cache_result):
+    """
+    Returns whether the given cached location of a file means it's
+    transferred to the remote storage, or all of multiple remote storages.
+
+    :param cache_result: the cached location of a file
+    :rtype: bool
+    """
+    if isinstance(cache_result, tuple):
+        return all(cache_result)
+    return bool(cache_result)
+
+
+def get_file_metadata(storage, name, checksum=None):
+    """
+    Returns the metadata of the file with the given name in the given
+    storage: its ``size``, ``modified_time``, ``created_time`` (``None`` if
+    not supported by the storage), ``content_type`` and ``checksum``, the
+    hex digest of its content using the given hash algorithm if any
+    (reading the whole file), otherwise ``None``.
+
+    :rtype: dict
+    """
+    metadata = {
+        'size': storage.size(name),
+        'content_type': mimetypes.guess_type(name)[0],
+        'checksum': None,
+    }
+    for key, method in (('modified_time', 'get_modified_time'),
+                        ('created_time', 'get_created_time')):
+        try:
+            metadata[key] = getattr(storage, method)(name)
+        except (AttributeError, NotImplementedError):
+            # e.g. Django < 1.10 or not supported by the storage
+            metadata[key] = None
+    if checksum:
+        digest = hashlib.new(checksum)
+        with storage.open(name) as content:
+            for chunk in content.chunks():
+                digest.update(chunk)
+        metadata['checksum'] = digest.hexdigest()
+    return metadata
+
+
+class Lease(object):
+    """
+    An exclusive lease on the given cache key, acquired with ``cache.add``
+    so that only one process holds it at a time. While held it's renewed
+    by a heartbeat thread, so it only expires after the given timeout if
+    the holder died.
+
+    :param key: the cache key of the lease
+    :type key: str
+    :param timeout: the number of seconds the lease expires after unless
+                    renewed
+    :type timeout: int
+    """
+    def __init__(self, key, timeout):
+        self.key = key
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+        self._stopped = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self):
+        """
+        Acquires the lease and starts renewing it.
+
+        :returns: whether the lease was acquired
+        :rtype: bool
+        """
+        if not cache.add(self.key, self.token, self.timeout):
+            return False
+        self._heartbeat = threading.Thread(target=self._renew)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+        return True
+
+    def _renew(self):
+        while not self._stopped.wait(self.timeout / 3.0):
+            if cache.get(self.key) != self.token:
+                # expired and taken over by another process
+                return
+            cache.set(self.key, self.token, self.timeout)
+
+    def release(self):
+        """
+        Stops renewing the lease and releases it, unless it was taken over
+        by another process in the meantime.
+        """
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+
+class Backlog(object):
+    """
+    Counts the files saved to the given local storage which aren't
+    transferred to the remote storage yet, and their total size in bytes,
+    in the cache. Each file is counted once, by a marker next to its cache
+    key which holds its size.
+
+    :param local: the local storage backend instance
+    """
+    def __init__(self, local):
+        location = getattr(local, 'location', repr(local))
+        self.key = '%s_backlog_%s' % (
+            settings.QUEUED_STORAGE_CACHE_PREFIX,
+            hashlib.md5(force_bytes(location)).hexdigest())
+
+    def get(self):
+        """
+        Returns the number of files and bytes in the backlog.
+
+        :rtype: tuple
+        """
+        counters = cache.get_many(['%s_files' % self.key,
+                                   '%s_bytes' % self.key])
+        # the counters may drift below zero if the cache lost markers
+        return (max(counters.get('%s_files' % self.key, 0), 0),
+                max(counters.get('%s_bytes' % self.key, 0), 0))
+
+    def reserve(self, size, max_files=None, max_bytes=None):
+        """
+        Counts a file of the given size if it fits into the given limits,
+        incrementing the counters first and decrementing them again if
+        they're exceeded, so that concurrent reservations can't overshoot
+        the limits together.
+
+        :returns: whether the file fits into the backlog
+        :rtype: bool
+        """
+        files, total = self._count(1, size)
+        if ((max_files is not None and files > max_files) or
+                (max_bytes is not None and total > max_bytes)):
+            self._count(-1, -size)
+            return False
+        return True
+
+    def release(self, size):
+        """
+        Gives back a reservation for a file of the given size, e.g. if the
+        file couldn't be saved after all.
+        """
+        self._count(-1, -size)
+
+    def add(self, cache_key, size, reserved=False):
+        """
+        Adds the file with the given cache key and size to the backlog,
+        counting it unless it's already counted by a reservation (see
+        :meth:`~queued_storage.utils.Backlog.reserve`).
+        """
+        cache.set('%s_backlog' % cache_key, size, None)
+        if not reserved:
+            self._count(1, size)
+
+    def remove(self, cache_key):
+        """
+        Removes the file with the given cache key from the backlog, e.g.
+        after transferring it.
+
+        :returns: whether the file was in the backlog
+        :rtype: bool
+        """
+        size = cache.get('%s_backlog' % cache_key)
+        if size is None:
+            return False
+        cache.delete('%s_backlog' % cache_key)
+        self._count(-1, -size)
+        return True
+
+    def _count(self, files, size):
+        counters = []
+        for key, delta in (('%s_files' % self.key, files),
+                           ('%s_bytes' % self.key, size)):
+            cache.add(key, 0, None)
+            try:
+                counters.append(cache.incr(key, delta))
+            except ValueError:
+                # evicted in the meantime
+                counters.append(delta)
+        return tuple(counters)
+
+
+def makedirs(directory, mode=None):
+    """
+    Creates the given directory (and its parents) if missing, optionally
+    using the given permissions mode.
+    """
+    if os.path.isdir(directory):
+        return
+    try:
+        if mode is not None:
+            old_umask = os.umask(0)
+            try:
+                os.makedirs(directory, mode)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def copy_content(source, target):
+    """
+    Copies the content of the source file object from its current position
+    to the target file object at the same position, in the kernel using
+    ``copy_file_range`` or ``sendfile`` where available and in Python
+    otherwise.
+    """
+    source_fd, target_fd = source.fileno(), target.fileno()
+    size = os.fstat(source_fd).st_size
+    copied = source.tell()
+    try:
+        if hasattr(os, 'copy_file_range'):
+            while copied < size:
+                count = os.copy_file_range(source_fd, target_fd, size - copied)
+                if not count:
+                    break
+                copied += count
+        elif hasattr(os, 'sendfile'):
+            while copied < size:
+                count = os.sendfile(target_fd, source_fd, copied, size - copied)
+                if not count:
+                    break
+                copied += count
+    except OSError:
+        # not supported for these files, e.g. sendfile on macOS
+        pass
+    source.seek(copied)
+    target.seek(copied)
+    shutil.copyfileobj(source, target)
+
+
+def copy_file(source, target, move=False,
+              file_permissions_mode=None, directory_permissions_mode=None,
+              resume=False):
+    """
+    Copies (or moves) the file at the source path to the target path without
+    passing its content through Python if possible: by hardlinking it (and
+    removing the source) when moving, or else by copying it in the kernel.
+    Copies aren't hardlinked, so that changing one of the files doesn't
+    change the other. The target file only appears once it's complete and
+    never replaces an existing file.
+
+    When resuming, the copy is written to a partial file next to the target
+    (see :func:`~queued_storage.utils.get_partial_path`) and kept if it
+    fails, so that the next attempt continues where it stopped, unless the
+    source file was changed since (see
+    :func:`~queued_storage.utils.remove_partial_files` to clean up partial
+    files which are never completed).
+
+    :raises: :exc:`OSError` with ``errno.EEXIST`` if the target exists
+    """
+    makedirs(os.path.dirname(target), directory_permissions_mode)
+    if move:
+        try:
+            os.link(source, target)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise
+            # e.g. across devices or not supported by the file system
+        else:
+            os.remove(source)
+            if file_permissions_mode is not None:
+                os.chmod(target, file_permissions_mode)
+            return
+
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    offset = 0
+    if resume:
+        temp_target = get_partial_path(source, target)
+        offset = get_resume_offset(source, temp_target)
+    else:
+        temp_target = '%s.%s%s' % (target, uuid.uuid4().hex, PARTIAL_SUFFIX)
+        flags |= os.O_EXCL
+    fd = os.open(temp_target, flags, 0o666)
+    try:
+        with open(source, 'rb') as source_file:
+            with os.fdopen(fd, 'wb') as target_file:
+                target_file.truncate(offset)
+                source_file.seek(offset)
+                target_file.seek(offset)
+                copy_content(source_file, target_file)
+        if file_permissions_mode is not None:
+            os.chmod(temp_target, file_permissions_mode)
+        publish_file(temp_target, target)
+    except Exception as e:
+        if ((not resume or getattr(e, 'errno', None) == errno.EEXIST) and
+                os.path.exists(temp_target)):
+            os.remove(temp_target)
+        raise
+    if move:
+        os.remove(source)
+
+
+def publish_file(source, target):
+    """
+    Renames the file at the source path to the target path unless a file
+    exists there, atomically where hardlinks are supported.
+
+    :raises: :exc:`OSError` with ``errno.EEXIST`` if the target exists
+    """
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            raise
+        # hardlinks aren't supported by the file system, reserve the name
+        # and replace the empty file with the complete one
+        os.close(os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o666))
+        os.rename(source, target)
+    else:
+        os.remove(source)
+
+
+def get_partial_path(source, target):
+    """
+    Returns the path of the partial file to copy the file at the source
+    path to the target path with, which is specific to the source file's
+    identity, size and modification time, so that a copy of a changed
+    source file never continues the copy of the previous one.
+
+    :rtype: str
+    """
+    source_stat = os.stat(source)
+    fingerprint = hashlib.md5(force_bytes(repr((
+        source_stat.st_dev, source_stat.st_ino, source_stat.st_size,
+        getattr(source_stat, 'st_mtime_ns', source_stat.st_mtime),
+    )))).hexdigest()[:16]
+    return '%s.%s%s' % (target, fingerprint, PARTIAL_SUFFIX)
+
+
+def get_resume_offset(source, partial):
+    """
+    Returns the offset to continue copying the file at the source path to
+    the partial file at the given path from, which is its size unless it's
+    larger than the source file or its last
+    :data:`~queued_storage.utils.RESUME_CHECK_SIZE` bytes differ from the
+    source file's.
+    """
+    try:
+        size = os.stat(partial).st_size
+    except OSError:
+        return 0
+    if size > os.stat(source).st_size:
+        return 0
+    start = max(size - RESUME_CHECK_SIZE, 0)
+    with open(source, 'rb') as source_file:
+        with open(partial, 'rb') as partial_file:
+            source_file.seek(start)
+            partial_file.seek(start)
+            if (source_file.read(size - start) !=
+                    partial_file.read(size - start)):
+                return 0
+    return size
+
+
+def remove_partial_files(directory, max_age):
+    """
+    Removes the partial files of copies to the given directory (but not its
+    subdirectories) which weren't written to for the given number of
+    seconds, e.g. because the source file was deleted or changed before the
+    copy could be completed.
+
+    :returns: the paths of the removed files
+    :rtype: list
+    """
+    removed = []
+    expired = time.time() - max_age
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        # e.g. not created yet
+        return removed
+    for name in names:
+        if not name.endswith(PARTIAL_SUFFIX):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.stat(path).st_mtime < expired:
+                os.remove(path)
+                removed.append(path)
+        except OSError:
+            # completed or removed in the meantime
+            pass
+    return removed
@@ -19,7 +19,8 @@ setup(
     long_description=read('README.rst'),
     author='Jannis Leidel',
     author_email='jannis@leidel.info',
-    packages=['queued_storage'],
+    packages=['queued_storage', 'queued_storage.management',
+              'queued_storage.management.commands'],
     classifiers=[
         'Development Status :: 4 - Beta',
         'Framework :: Django',
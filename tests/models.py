@@ -5,6 +5,8 @@ from queued_storage.fields import QueuedFileField
 
 class TestModel(models.Model):
     testfile = models.FileField(upload_to='test', null=True)
-    remote = QueuedFileField(upload_to='test', null=True)
+    remote = QueuedFileField(upload_to='test', null=True,
+                             location_field='remote_location')
+    remote_location = models.CharField(max_length=8, null=True)
 
     retried = False
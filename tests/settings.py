@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 SITE_ID = 1
 
 DATABASES = {
@@ -18,5 +21,11 @@ SECRET_KEY = 'top_secret'
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
+    },
+    # shared between processes, for the MemoryStagingStorage
+    'staging': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(),
+                                 'queued_storage_staging'),
+    },
 }
@@ -1,4 +1,6 @@
-from queued_storage.tasks import Transfer
+from django.core.files.storage import FileSystemStorage
+
+from queued_storage.tasks import Delete, Fetch, Transfer, TransferAndCache
 from queued_storage.utils import import_attribute
 
 from .models import TestModel
@@ -23,6 +25,10 @@ class NoneReturningTask(Transfer):
         return None
 
 
+class SingleRetryTransfer(Transfer):
+    max_retries = 1
+
+
 class RetryingTask(Transfer):
     def transfer(self, *args, **kwargs):
         if TestModel.retried:
@@ -30,3 +36,65 @@ class RetryingTask(Transfer):
         else:
             TestModel.retried = True
             return False
+
+
+class SingleFileCacheTask(TransferAndCache):
+    max_files = 1
+    eviction_interval = 0
+
+
+class GzipTransfer(Transfer):
+    compression = 'gzip'
+    compression_min_size = 0
+    metadata_checksum = 'md5'
+
+
+class SmallFetch(Fetch):
+    max_size = 2
+
+
+class PooledTransfer(Transfer):
+    pool_size = 2
+
+
+class SmallBatchDelete(Delete):
+    batch_size = 2
+
+
+class FlakyStorage(FileSystemStorage):
+    """
+    A file system storage failing to save the first file.
+    """
+    failed = False
+
+    def _save(self, name, content):
+        if not FlakyStorage.failed:
+            FlakyStorage.failed = True
+            raise IOError("Failing once")
+        return super(FlakyStorage, self)._save(name, content)
+
+
+class CountingStorage(FileSystemStorage):
+    """
+    A file system storage recording the names it's asked about.
+    """
+    exists_calls = []
+
+    def exists(self, name):
+        CountingStorage.exists_calls.append(name)
+        return super(CountingStorage, self).exists(name)
+
+
+class BatchDeleteStorage(FileSystemStorage):
+    """
+    A file system storage deleting files in batches, failing the first
+    batch.
+    """
+    batches = []
+
+    def delete_many(self, names):
+        BatchDeleteStorage.batches.append(list(names))
+        if len(BatchDeleteStorage.batches) == 1:
+            raise IOError("Failing once")
+        for name in names:
+            self.delete(name)
@@ -5,23 +5,52 @@ the QueuedStorage backend is truly agnostic about the local and remote
 storage systems, this should work as transparently as using one (or even two!)
 remote storage systems.
 """
+import errno
 import os
 import shutil
+import sys
 import tempfile
+import threading
 from os import path
 from datetime import datetime
+from unittest import skipIf
+import six
 from packaging import version
 from packaging.specifiers import SpecifierSet
 
 import django
-from django.core.files.base import File
+from django.core.files.base import ContentFile, File
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.files.storage import FileSystemStorage, Storage
-from django.test import TestCase
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import override_settings
 
-from queued_storage.backends import QueuedStorage
+try:
+    import debug_toolbar
+except ImportError:
+    debug_toolbar = None
+
+from queued_storage.backends import BacklogFull, QueuedStorage, warm_up
+from queued_storage.compression import ENCODINGS, compress, decompress
 from queued_storage.conf import settings
+from queued_storage.fields import transfer_queued_files
+from queued_storage.profiling import ProfilerMiddleware
+from queued_storage.signals import transfer_contended
+from queued_storage.storages import (MemoryStagingStorage,
+                                     S3BatchDeleteMixin,
+                                     ShardedFileSystemStorage)
+from queued_storage.tasks import Transfer
+from queued_storage.utils import (PARTIAL_SUFFIX, Backlog, BackendPool,
+                                  Lease, copy_file, get_backend,
+                                  get_backend_pool, get_partial_path,
+                                  get_resume_offset, remove_partial_files)
 
-from . import models
+from . import models, tasks
 
 DJANGO_VERSION = django.get_version()
 
@@ -43,6 +72,7 @@ class StorageTests(TestCase):
         self.addCleanup(shutil.rmtree, self.local_dir)
         self.addCleanup(shutil.rmtree, self.remote_dir)
         self.addCleanup(shutil.rmtree, tmp_dir)
+        self.addCleanup(cache.clear)
 
     def tearDown(self):
         settings.CELERY_ALWAYS_EAGER = self.old_celery_always_eager
@@ -58,6 +88,72 @@ class StorageTests(TestCase):
         self.assertEqual(FileSystemStorage, storage.local.__class__)
         self.assertEqual(FileSystemStorage, storage.remote.__class__)
 
+    def test_storage_lazy_import(self):
+        """
+        Make sure backends are only imported on first use
+        """
+        storage = QueuedStorage(
+            'django.core.files.storage.FileSystemStorage',
+            'tests.does_not_exist.RemoteStorage')
+        with self.assertRaises(ImproperlyConfigured):
+            storage.remote.exists(self.test_file_name)
+
+    def test_storage_shared_backends(self):
+        """
+        Make sure storages with the same backend options share instances
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir))
+        other_storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir))
+        self.assertEqual(storage.local.location, other_storage.local.location)
+        self.assertIs(storage.local._wrapped, other_storage.local._wrapped)
+        self.assertIsNot(storage.local._wrapped, storage.remote._wrapped)
+
+    def test_storage_aliases(self):
+        """
+        Make sure storages can be referenced by alias and that transfers
+        only pass around the alias
+        """
+        backends = {
+            'local': {
+                'BACKEND': 'django.core.files.storage.FileSystemStorage',
+                'OPTIONS': {'location': self.local_dir},
+            },
+            'remote': {
+                'BACKEND': 'django.core.files.storage.FileSystemStorage',
+                'OPTIONS': {'location': self.remote_dir},
+            },
+        }
+        with override_settings(QUEUED_STORAGE_BACKENDS=backends):
+            storage = QueuedStorage('local', 'remote')
+            self.assertEqual(storage.remote_options, {})
+            self.assertEqual(storage.remote.location, self.remote_dir)
+            self.assertIs(storage.remote._wrapped, get_backend('remote'))
+            self.assertIs(storage.remote._wrapped, get_backend(
+                'django.core.files.storage.FileSystemStorage',
+                {'location': self.remote_dir}))
+
+            field = models.TestModel._meta.get_field('testfile')
+            field.storage = storage
+
+            obj = models.TestModel()
+            obj.testfile.save(self.test_file_name, File(self.test_file))
+            obj.save()
+
+            self.assertTrue(obj.testfile.storage.result.get())
+            self.assertTrue(
+                path.isfile(path.join(self.remote_dir, obj.testfile.name)))
+
+            with self.assertRaises(ImproperlyConfigured):
+                get_backend('remote', {'location': self.local_dir})
+
     def test_storage_cache_key(self):
         storage = QueuedStorage(
             'django.core.files.storage.FileSystemStorage',
@@ -65,6 +161,35 @@ class StorageTests(TestCase):
             cache_prefix='test_cache_key')
         self.assertEqual(storage.cache_prefix, 'test_cache_key')
 
+        cache_key = storage.get_cache_key(self.test_file_name)
+        self.assertTrue(cache_key.startswith('test_cache_key_'))
+        self.assertTrue(cache_key.endswith('_' + self.test_file_name))
+        self.assertEqual(storage.get_cache_key(self.test_file_name), cache_key)
+        self.assertLess(len(storage.get_cache_key('a' * 1000)), 250)
+        self.assertNotEqual(storage.get_cache_key('a' * 1000),
+                            storage.get_cache_key('a' * 1001))
+
+    def test_storage_invalidate_cache(self):
+        """
+        Make sure all cached locations can be invalidated at once
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir))
+        name = storage.save(self.test_file_name, File(self.test_file))
+        self.assertTrue(storage.using_remote(name))
+        old_cache_key = storage.get_cache_key(name)
+        self.assertTrue(cache.get(old_cache_key))
+
+        # e.g. moved to a new bucket
+        os.remove(path.join(self.remote_dir, name))
+        generation = storage.get_cache_generation()
+        self.assertNotEqual(storage.invalidate_cache(), generation)
+        self.assertNotEqual(storage.get_cache_key(name), old_cache_key)
+        self.assertTrue(storage.using_local(name))
+
     def test_storage_methods(self):
         """
         Make sure that QueuedStorage implements all the methods
@@ -165,6 +290,565 @@ class StorageTests(TestCase):
         storage.delete(subdir_name)
         self.assertFalse(storage.exists(subdir_name))
 
+    def test_storage_ignore_result(self):
+        """
+        Make sure transfers can be queued without keeping their results
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            ignore_result=True)
+        name = storage.save(self.test_file_name, File(self.test_file))
+        self.assertIsNone(storage.result)
+        self.assertTrue(path.isfile(path.join(self.remote_dir, name)))
+        self.assertTrue(storage.using_remote(name))
+
+    def test_storage_result_thread_local(self):
+        """
+        Make sure the result of the last transfer is kept per thread
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir))
+        thread = threading.Thread(
+            target=storage.save,
+            args=(self.test_file_name, File(self.test_file)))
+        thread.start()
+        thread.join()
+        self.assertIsNone(storage.result)
+        storage.save('other.txt', ContentFile(b'test'))
+        self.assertTrue(storage.result.get())
+
+    def test_storage_inline_transfer(self):
+        """
+        Make sure small files are uploaded right away, and the transfers
+        of larger ones or failed uploads are queued
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='tests.tasks.FlakyStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            inline_max_size=10)
+        self.addCleanup(setattr, tasks.FlakyStorage, 'failed', False)
+        tasks.FlakyStorage.failed = True
+        small = storage.save('small.txt', ContentFile(b'test'))
+        self.assertIsNone(storage.result)
+        self.assertTrue(cache.get(storage.get_cache_key(small)))
+        self.assertTrue(path.isfile(path.join(self.remote_dir, small)))
+
+        large = storage.save('large.txt', ContentFile(b'test' * 10))
+        self.assertTrue(storage.result.get())
+        self.assertTrue(storage.using_remote(large))
+
+        tasks.FlakyStorage.failed = False
+        failed = storage.save('failed.txt', ContentFile(b'test'))
+        self.assertTrue(tasks.FlakyStorage.failed)
+        self.assertTrue(storage.result.get())
+        self.assertTrue(storage.using_remote(failed))
+
+    def test_storage_backlog(self):
+        """
+        Make sure files are only saved while they fit into the backlog of
+        files waiting for their transfers
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            delayed=True, max_backlog_files=2, max_backlog_bytes=10)
+        first = storage.save('first.txt', ContentFile(b'test'))
+        second = storage.save('second.txt', ContentFile(b'test'))
+        self.assertEqual(storage.get_backlog(), (2, 8))
+        self.assertRaises(BacklogFull, storage.save,
+                          'third.txt', ContentFile(b'test'))
+        self.assertFalse(storage.local.exists('third.txt'))
+        self.assertEqual(storage.get_backlog(), (2, 8))
+
+        self.assertTrue(storage.transfer(first).get())
+        self.assertEqual(storage.get_backlog(), (1, 4))
+        self.assertRaises(BacklogFull, storage.save,
+                          'large.txt', ContentFile(b'test' * 2))
+        storage.delete(second)
+        self.assertEqual(storage.get_backlog(), (0, 0))
+        large = storage.save('large.txt', ContentFile(b'test' * 2))
+        self.assertEqual(storage.get_backlog(), (1, 8))
+
+        # files saved with another name than the given one
+        storage.max_backlog_bytes = None
+        renamed = storage.save('large.txt', ContentFile(b'test'))
+        self.assertNotEqual(renamed, large)
+        self.assertEqual(storage.get_backlog(), (2, 12))
+        self.assertTrue(storage.transfer(renamed).get())
+        storage.delete(large)
+        self.assertEqual(storage.get_backlog(), (0, 0))
+
+        # reservations of files which fail to save are given back
+        def fail(*args, **kwargs):
+            raise IOError(errno.ENOSPC, 'No space left on device')
+        storage.local.save = fail
+        try:
+            self.assertRaises(IOError, storage.save,
+                              'full.txt', ContentFile(b'test'))
+        finally:
+            del storage.local.save
+        self.assertEqual(storage.get_backlog(), (0, 0))
+
+        # concurrent saves can't overshoot the limits together
+        backlog = Backlog(storage.local)
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(backlog.reserve(4, max_files=3)))
+            for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(True), 3)
+        self.assertEqual(storage.get_backlog(), (3, 12))
+
+        self.assertRaises(ImproperlyConfigured, QueuedStorage,
+                          local='django.core.files.storage.FileSystemStorage',
+                          remote='django.core.files.storage.FileSystemStorage',
+                          backlog_policy='drop')
+
+    def test_storage_backlog_policies(self):
+        """
+        Make sure files saved while the backlog is full are uploaded right
+        away or wait for the backlog to drain, depending on the policy
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            max_backlog_files=1, backlog_policy='inline', inline_max_size=10)
+        Backlog(storage.local).add('pending', 4)
+
+        small = storage.save('small.txt', ContentFile(b'test'))
+        self.assertIsNone(storage.result)
+        self.assertTrue(path.isfile(path.join(self.remote_dir, small)))
+        self.assertEqual(storage.get_backlog(), (1, 4))
+        self.assertRaises(BacklogFull, storage.save,
+                          'large.txt', ContentFile(b'test' * 10))
+
+        storage.backlog_policy = 'throttle'
+        storage.backlog_throttle_timeout = 0.05
+        self.assertRaises(BacklogFull, storage.save,
+                          'throttled.txt', ContentFile(b'test'))
+        timer = threading.Timer(0.05, Backlog(storage.local).remove,
+                                args=('pending',))
+        storage.backlog_throttle_timeout = 5
+        timer.start()
+        throttled = storage.save('throttled.txt', ContentFile(b'test'))
+        timer.join()
+        self.assertTrue(storage.using_remote(throttled))
+        self.assertEqual(storage.get_backlog(), (0, 0))
+
+    def test_storage_memory_staging(self):
+        """
+        Make sure small files are staged in the cache, larger ones are
+        spilled to the disk, and both are deleted once transferred
+        """
+        self.addCleanup(caches['staging'].clear)
+        storage = QueuedStorage(
+            local='queued_storage.storages.MemoryStagingStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir, max_memory_size=10,
+                               cache_alias='staging'),
+            remote_options=dict(location=self.remote_dir),
+            delayed=True)
+        small = storage.save('small.txt', ContentFile(b'test'))
+        large = storage.save('large.txt', ContentFile(b'test' * 3))
+        self.assertEqual(os.listdir(self.local_dir), [large])
+        self.assertTrue(storage.exists(small))
+        self.assertEqual(storage.open(small).read(), b'test')
+        self.assertEqual(storage.size(small), 4)
+        self.assertIsNotNone(storage.local.get_modified_time(small))
+        self.assertRaises(NotImplementedError, storage.path, small)
+        self.assertEqual(storage.path(large),
+                         path.join(self.local_dir, large))
+
+        # files the cache refuses are spilled to the disk
+        def full(*args, **kwargs):
+            raise IOError("The cache is full")
+        storage.local.cache.add = full
+        spilled = storage.save('spilled.txt', ContentFile(b'test'))
+        del storage.local.cache.add
+        self.assertTrue(path.isfile(path.join(self.local_dir, spilled)))
+        storage.delete(spilled)
+
+        for name in (small, large):
+            self.assertTrue(storage.transfer(name).get())
+            self.assertTrue(storage.using_remote(name))
+            self.assertFalse(storage.local.exists(name))
+        self.assertEqual(storage.open(small).read(), b'test')
+        self.assertEqual(os.listdir(self.local_dir), [])
+
+        # the cache has to be shared with the workers
+        self.assertRaises(ImproperlyConfigured, MemoryStagingStorage,
+                          location=self.local_dir)
+        self.assertRaises(ImproperlyConfigured, MemoryStagingStorage,
+                          location=self.local_dir, cache_alias='default')
+
+    def test_storage_queued_delete(self):
+        """
+        Make sure files are marked deleted right away and deleted from the
+        remote storage in batches by a task, which is retried
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='tests.tasks.BatchDeleteStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            delayed=True, queued_delete=True,
+            delete_task='tests.tasks.SmallBatchDelete')
+        names = [storage.save('photo%d.txt' % index, ContentFile(b'test'))
+                 for index in range(5)]
+        for name in names[:4]:
+            self.assertTrue(storage.transfer(name).get())
+        tasks.BatchDeleteStorage.batches = []
+        self.addCleanup(setattr, tasks.BatchDeleteStorage, 'batches', [])
+
+        storage.delete_many(names)
+        # the file which isn't transferred may be stored compressed
+        self.assertEqual(tasks.BatchDeleteStorage.batches,
+                         [names[:2], names[2:4],
+                          [names[4], names[4] + '.gz'], [names[4] + '.zst'],
+                          names[:2]])
+        self.assertEqual(os.listdir(self.local_dir), [])
+        self.assertEqual(os.listdir(self.remote_dir), [])
+        for name in names:
+            self.assertFalse(storage.exists(name))
+            self.assertEqual(cache.get(storage.get_cache_key(name)), False)
+
+        # deleting files again succeeds
+        storage.delete(names[0])
+        self.assertEqual(tasks.BatchDeleteStorage.batches[-2:],
+                         [[names[0], names[0] + '.gz'], [names[0] + '.zst']])
+
+    def test_storage_queued_delete_transfer(self):
+        """
+        Make sure a transfer finishing after the file was deleted doesn't
+        mark it transferred, that the delete task waits for the lease of
+        a transfer and that saving the file again keeps it
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            delayed=True, queued_delete=True,
+            delete_task='tests.tasks.SmallBatchDelete')
+        name = storage.save('photo.txt', ContentFile(b'test'))
+        cache_key = storage.get_cache_key(name)
+
+        # the file is deleted while it's transferred
+        cache.set('%s_deleted' % cache_key, True)
+        self.assertTrue(storage.transfer(name).get())
+        self.assertEqual(cache.get(cache_key), False)
+        self.assertTrue(storage.remote.exists(name))
+
+        # the delete task doesn't delete files leased by a transfer
+        cache.add('%s_lease' % cache_key, 'transfer')
+        self.addCleanup(cache.delete, '%s_lease' % cache_key)
+        tasks.SmallBatchDelete.max_retries = 0
+        self.addCleanup(delattr, tasks.SmallBatchDelete, 'max_retries')
+        self.assertTrue(storage.delete_many([name]).failed())
+        self.assertTrue(storage.remote.exists(name))
+        self.assertEqual(cache.get('%s_lease' % cache_key), 'transfer')
+
+        cache.delete('%s_lease' % cache_key)
+        storage.delete(name)
+        self.assertFalse(storage.remote.exists(name))
+        self.assertIsNone(cache.get('%s_deleted' % cache_key))
+
+        # the file saved again isn't deleted by a pending delete task
+        cache.set('%s_deleted' % cache_key, True)
+        self.assertEqual(storage.save(name, ContentFile(b'new')), name)
+        self.assertIsNone(cache.get('%s_deleted' % cache_key))
+        self.assertTrue(storage.transfer(name).get())
+        tasks.SmallBatchDelete().apply(
+            args=([[name]], [cache_key], storage.remote_path,
+                  storage.remote_options)).get()
+        self.assertTrue(storage.remote.exists(name))
+
+    def test_s3_batch_delete(self):
+        """
+        Make sure the S3 storages delete files with one request per 1000
+        files with both boto and boto3, and raise for files S3 couldn't
+        delete
+        """
+        class Boto3Bucket(object):
+            requests = []
+
+            def delete_objects(self, Delete):
+                self.requests.append([obj['Key'] for obj in Delete['Objects']])
+                return {'Errors': [{'Key': key, 'Message': 'Access Denied'}
+                                   for key in self.requests[-1]
+                                   if key.endswith('locked')]}
+
+        class BotoBucket(object):
+            requests = []
+
+            def delete_keys(self, keys, quiet):
+                self.requests.append(list(keys))
+                return type('MultiDeleteResult', (), {'errors': []})
+
+        class S3Storage(S3BatchDeleteMixin):
+            max_delete_keys = 2
+
+            def __init__(self, bucket):
+                self.bucket = bucket
+
+            def _clean_name(self, name):
+                return name.replace('\\', '/')
+
+            def _normalize_name(self, name):
+                return 'media/' + name
+
+        names = ['a.txt', 'b\\c.txt', 'd.txt']
+        S3Storage(Boto3Bucket()).delete_many(names)
+        self.assertEqual(Boto3Bucket.requests,
+                         [['media/a.txt', 'media/b/c.txt'], ['media/d.txt']])
+        S3Storage(BotoBucket()).delete_many(names)
+        self.assertEqual(BotoBucket.requests,
+                         [['media/a.txt', 'media/b/c.txt'], ['media/d.txt']])
+        self.assertRaises(IOError, S3Storage(Boto3Bucket()).delete_many,
+                          ['locked'])
+
+    def test_storage_listdir_merged(self):
+        """
+        Make sure directories are listed in both storages, page by page,
+        and the locations of the remote files are cached
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            delayed=True)
+        storage.local.save('dir/local.txt', ContentFile(b'test'))
+        storage.local.save('dir/both.txt', ContentFile(b'test'))
+        storage.local.save('dir/sub/file.txt', ContentFile(b'test'))
+        storage.remote.save('dir/both.txt', ContentFile(b'test'))
+        storage.remote.save('dir/remote.txt', ContentFile(b'test'))
+        storage.remote.save('dir/sub/file.txt', ContentFile(b'test'))
+        # not compressed by the storage, which doesn't compress files
+        storage.remote.save('dir/export.txt.gz', ContentFile(b'test'))
+
+        self.assertEqual(storage.listdir('dir'),
+                         (['sub'], ['both.txt', 'export.txt.gz', 'local.txt',
+                                    'remote.txt']))
+        self.assertTrue(cache.get(storage.get_cache_key('dir/remote.txt')))
+        self.assertIs(cache.get(storage.get_cache_key('dir/export.txt.gz')),
+                      True)
+        self.assertIsNone(cache.get(storage.get_cache_key('dir/export.txt')))
+        self.assertTrue(cache.get(storage.get_cache_key('dir/both.txt')))
+        self.assertIsNone(cache.get(storage.get_cache_key('dir/local.txt')))
+
+        directories, files, cursor = storage.listdir_page('dir', limit=2)
+        self.assertEqual((directories, files),
+                         ([], ['both.txt', 'export.txt.gz']))
+        directories, files, cursor = storage.listdir_page('dir', cursor,
+                                                          limit=3)
+        self.assertEqual((directories, files),
+                         (['sub'], ['local.txt', 'remote.txt']))
+        self.assertIsNone(cursor)
+        self.assertEqual(storage.listdir('missing'), ([], []))
+
+    def test_storage_metadata(self):
+        """
+        Make sure the metadata of transferred files is recorded and used
+        instead of asking the remote storage
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            task='tests.tasks.GzipTransfer')
+        name = storage.save(self.test_file_name, File(self.test_file))
+        self.assertTrue(storage.result.get())
+        modified_time = storage.local.get_modified_time(name)
+
+        metadata = storage.get_metadata(name)
+        self.assertEqual(metadata['size'], 4)
+        self.assertEqual(metadata['content_type'], 'text/plain')
+        self.assertEqual(metadata['checksum'],
+                         '098f6bcd4621d373cade4e832627b4f6')
+        self.assertEqual(metadata['modified_time'], modified_time)
+
+        os.remove(path.join(self.remote_dir, name + '.gz'))
+        self.assertEqual(storage.size(name), 4)
+        self.assertEqual(storage.get_modified_time(name), modified_time)
+
+        storage.delete(name)
+        self.assertIsNone(storage.get_metadata(name))
+
+        # files aren't read again to compute checksums by default
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir))
+        name = storage.save(self.test_file_name, File(self.test_file))
+        self.assertTrue(storage.result.get())
+        self.assertEqual(storage.get_metadata(name)['size'], 4)
+        self.assertIsNone(storage.get_metadata(name)['checksum'])
+
+    def test_backend_pool(self):
+        """
+        Make sure pools are bounded and replace unhealthy backends
+        """
+        pool = BackendPool('django.core.files.storage.FileSystemStorage',
+                           {'location': self.remote_dir}, size=2)
+        first, second = pool.acquire(), pool.acquire()
+        self.assertIsNot(first, second)
+        self.assertEqual(first.location, self.remote_dir)
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(
+            pool.acquire()))
+        thread.start()
+        thread.join(0.1)
+        self.assertEqual(acquired, [])
+        pool.release(first)
+        thread.join()
+        self.assertEqual(acquired, [first])
+        pool.release(second, healthy=False)
+        self.assertIsNot(pool.acquire(), second)
+
+    def test_storage_warm_up(self):
+        """
+        Make sure the backends of queued storages can be warmed up and
+        pooled backends are used for transfers
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            task='tests.tasks.PooledTransfer')
+        self.assertGreaterEqual(warm_up(), 1)
+        self.assertIs(storage.remote._wrapped, get_backend(
+            'django.core.files.storage.FileSystemStorage',
+            {'location': self.remote_dir}))
+
+        name = storage.save(self.test_file_name, File(self.test_file))
+        self.assertTrue(storage.result.get())
+        self.assertTrue(path.isfile(path.join(self.remote_dir, name)))
+        pool = get_backend_pool('django.core.files.storage.FileSystemStorage',
+                                {'location': self.remote_dir}, 2)
+        self.assertEqual(pool.size, 2)
+        self.assertEqual(len(pool._idle), 1)
+        self.assertIsNot(pool, get_backend_pool(
+            'django.core.files.storage.FileSystemStorage',
+            {'location': self.remote_dir}, 3))
+
+        # pools of backends with unhashable options aren't shared
+        options = {'location': self.remote_dir, 'file_permissions_mode': None,
+                   'directory_permissions_mode': None}
+        options['base_url'] = type('URL', (str,), {'__hash__': None})('/')
+        pool = get_backend_pool('django.core.files.storage.FileSystemStorage',
+                                options, 2)
+        other = get_backend_pool('django.core.files.storage.FileSystemStorage',
+                                 options, 2)
+        self.assertIsNot(pool, other)
+        backend = pool.acquire()
+        other.release(backend)
+        self.assertEqual(len(other._idle), 0)
+        pool.release(backend)
+        self.assertEqual(len(pool._idle), 1)
+
+    def test_profiler_middleware(self):
+        """
+        Make sure the storage calls of requests are recorded and N+1
+        patterns are detected
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir))
+        names = [storage.save('file%d.txt' % index, ContentFile(b'test'))
+                 for index in range(10)]
+
+        def view(request):
+            return HttpResponse(''.join(storage.url(name) for name in names))
+
+        request = RequestFactory().get('/')
+        middleware = ProfilerMiddleware()
+        middleware.process_request(request)
+        response = middleware.process_response(request, view(request))
+        self.assertEqual(response['X-Queued-Storage-Calls'], '10')
+        profile = request.queued_storage_profile
+        self.assertEqual(profile.summary(), {'url': 10})
+        self.assertEqual(profile.calls[0]['cache_hits'], 1)
+        self.assertEqual(profile.calls[0]['backend'],
+                         'remote (FileSystemStorage)')
+        self.assertEqual(profile.n_plus_one(), [('url', 10)])
+        self.assertEqual(profile.n_plus_one(threshold=11), [])
+
+        # not recorded without the middleware
+        storage.url(names[0])
+        self.assertEqual(len(profile.calls), 10)
+
+    @skipIf(debug_toolbar is None, "requires django-debug-toolbar")
+    def test_debug_toolbar_panel(self):
+        """
+        Make sure the panel renders the recorded storage calls and N+1
+        patterns
+        """
+        from queued_storage.panels import QueuedStoragePanel
+
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir))
+        names = [storage.save('file%d.txt' % index, ContentFile(b'test'))
+                 for index in range(10)]
+
+        # the toolbar only needs to keep the stats of its panels
+        panel = QueuedStoragePanel.__new__(QueuedStoragePanel)
+        panel.toolbar = type('Toolbar', (), {'stats': {}})()
+        panel.enable_instrumentation()
+        for name in names:
+            storage.url(name)
+        panel.disable_instrumentation()
+
+        six.assertRegex(self, panel.nav_subtitle,
+                        r'^10 calls in \d+\.\d\dms$')
+        content = panel.content
+        self.assertIn('QueuedStorage.url was called for 10 files', content)
+        self.assertEqual(content.count('<tr><td>url</td>'), 10)
+        six.assertRegex(self, content, r'<td>\d+\.\d\dms</td>')
+        self.assertIn('remote (FileSystemStorage)', content)
+
+    def test_loadtest_command(self):
+        """
+        Make sure the load test command saves and transfers files and
+        reports the results
+        """
+        out = six.StringIO()
+        call_command('queued_storage_loadtest', files=20, concurrency=2,
+                     workers=2, sizes='1k:3,10k:1', remote_latency=0.01,
+                     sample_interval=0.01, seed=1, stdout=out)
+        output = out.getvalue()
+        self.assertIn('Saved 20 files', output)
+        self.assertIn('Transferred 20 files', output)
+        self.assertIn('0 failed', output)
+        self.assertIn('Save-to-remote latency: p50', output)
+        self.assertIn('Queue depth:', output)
+
+        with self.assertRaises(CommandError):
+            call_command('queued_storage_loadtest', sizes='big', stdout=out)
+
     def test_transfer_and_delete(self):
         """
         Make sure the TransferAndDelete task does what it says
@@ -192,6 +876,409 @@ class StorageTests(TestCase):
             path.isfile(path.join(self.remote_dir, obj.testfile.name)),
             "Remote file is not available.")
 
+    def test_transfer_file_system_fast_path(self):
+        """
+        Make sure files are copied between file system storages without
+        sharing the local copy, and the file system of subclasses isn't
+        used directly
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir))
+
+        field = models.TestModel._meta.get_field('testfile')
+        field.storage = storage
+
+        obj = models.TestModel()
+        obj.testfile.save(self.test_file_name, File(self.test_file))
+        obj.save()
+
+        self.assertTrue(obj.testfile.storage.result.get())
+        local_stat = os.stat(path.join(self.local_dir, obj.testfile.name))
+        remote_stat = os.stat(path.join(self.remote_dir, obj.testfile.name))
+        self.assertNotEqual(local_stat.st_ino, remote_stat.st_ino)
+
+        task = Transfer()
+        local = FileSystemStorage(location=self.local_dir)
+        self.assertFalse(task.transfer_file(
+            obj.testfile.name, local,
+            tasks.FlakyStorage(location=self.remote_dir)))
+        # the remote file exists already
+        self.assertFalse(task.transfer_file(
+            obj.testfile.name, local,
+            FileSystemStorage(location=self.remote_dir)))
+
+    def test_copy_file(self):
+        """
+        Make sure files are copied and moved on the file system
+        """
+        copy_target = path.join(self.remote_dir, 'copy', self.test_file_name)
+        copy_file(self.test_file_path, copy_target)
+        with open(copy_target) as copied_file:
+            self.assertEqual(copied_file.read(), 'test')
+        self.assertNotEqual(os.stat(copy_target).st_ino,
+                            os.stat(self.test_file_path).st_ino)
+        self.assertEqual(os.listdir(path.dirname(copy_target)),
+                         [self.test_file_name])
+        with self.assertRaises(OSError) as cm:
+            copy_file(self.test_file_path, copy_target)
+        self.assertEqual(cm.exception.errno, errno.EEXIST)
+        self.assertEqual(os.listdir(path.dirname(copy_target)),
+                         [self.test_file_name])
+
+        move_target = path.join(self.remote_dir, 'move', self.test_file_name)
+        copy_file(copy_target, move_target, move=True,
+                  file_permissions_mode=0o640)
+        self.assertFalse(path.exists(copy_target))
+        self.assertEqual(os.stat(move_target).st_mode & 0o777, 0o640)
+
+    def test_copy_file_resumed(self):
+        """
+        Make sure failed copies are resumed unless the source file changed,
+        and stale partial files are removed
+        """
+        source = path.join(self.local_dir, 'source.txt')
+        with open(source, 'wb') as source_file:
+            source_file.write(b'0123456789')
+        target = path.join(self.remote_dir, 'target.txt')
+        partial = get_partial_path(source, target)
+        self.assertTrue(partial.endswith(PARTIAL_SUFFIX))
+
+        # the first 4 bytes were copied before failing
+        with open(partial, 'wb') as partial_file:
+            partial_file.write(b'0123')
+        self.assertEqual(get_resume_offset(source, partial), 4)
+        copy_file(source, target, resume=True)
+        with open(target, 'rb') as target_file:
+            self.assertEqual(target_file.read(), b'0123456789')
+        self.assertFalse(path.exists(partial))
+        os.remove(target)
+
+        # the partial copy doesn't match the source file
+        with open(partial, 'wb') as partial_file:
+            partial_file.write(b'abcd')
+        self.assertEqual(get_resume_offset(source, partial), 0)
+        copy_file(source, target, resume=True)
+        with open(target, 'rb') as target_file:
+            self.assertEqual(target_file.read(), b'0123456789')
+        os.remove(target)
+
+        # the source file was changed after the partial copy
+        with open(partial, 'wb') as partial_file:
+            partial_file.write(b'0123')
+        os.utime(source, (0, 0))
+        self.assertNotEqual(get_partial_path(source, target), partial)
+
+        stale = path.join(self.remote_dir, 'stale.txt' + PARTIAL_SUFFIX)
+        nested = path.join(self.remote_dir, 'sub', 'stale.txt' + PARTIAL_SUFFIX)
+        upload = path.join(self.remote_dir, 'archive.zip.part')
+        os.makedirs(path.dirname(nested))
+        for stale_path in (stale, nested, upload, partial):
+            open(stale_path, 'wb').close()
+            os.utime(stale_path, (0, 0))
+        self.assertEqual(sorted(remove_partial_files(self.remote_dir, 3600)),
+                         sorted([partial, stale]))
+        self.assertTrue(path.exists(nested))
+        self.assertTrue(path.exists(upload))
+        self.assertEqual(remove_partial_files(self.remote_dir, 3600), [])
+
+    def test_transfer_and_cache(self):
+        """
+        Make sure the TransferAndCache task evicts the least recently used
+        local copies and that those are preferred as long as they exist
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            task='tests.tasks.SingleFileCacheTask',
+            prefer_local=True)
+
+        first_name = storage.save('first.txt', File(self.test_file))
+        first_path = path.join(self.local_dir, first_name)
+        self.assertTrue(storage.using_local(first_name))
+        self.assertTrue(path.isfile(first_path))
+        # make it the least recently used file
+        os.utime(first_path, (0, 0))
+
+        second_name = storage.save('second.txt', File(self.test_file))
+        self.assertFalse(path.isfile(first_path))
+        self.assertTrue(storage.using_remote(first_name))
+        self.assertTrue(storage.using_local(second_name))
+
+        storage.delete(second_name)
+        self.assertFalse(storage.exists(second_name))
+        self.assertFalse(path.isfile(path.join(self.remote_dir, second_name)))
+
+    def test_read_through(self):
+        """
+        Make sure remote files are copied to the local storage when opened
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            read_through=True)
+        name = storage.remote.save(self.test_file_name, File(self.test_file))
+        self.assertTrue(storage.using_remote(name))
+
+        # already being fetched
+        fetch_key = '%s_fetch' % storage.get_cache_key(name)
+        cache.add(fetch_key, True)
+        self.assertIsNone(storage.fetch(name))
+        cache.delete(fetch_key)
+
+        with storage.open(name) as remote_file:
+            self.assertEqual(remote_file.read(), b'test')
+        self.assertTrue(path.isfile(path.join(self.local_dir, name)))
+        self.assertTrue(storage.using_local(name))
+        with storage.open(name) as local_file:
+            self.assertEqual(local_file.read(), b'test')
+
+    def test_read_through_too_large(self):
+        """
+        Make sure files too large to copy to the local storage aren't
+        fetched again each time they're opened
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            read_through=True, fetch_task='tests.tasks.SmallFetch')
+        name = storage.remote.save(self.test_file_name, File(self.test_file))
+        self.assertFalse(storage.fetch(name).get())
+        self.assertIsNone(storage.fetch(name))
+        with storage.open(name) as remote_file:
+            self.assertEqual(remote_file.read(), b'test')
+        self.assertFalse(path.isfile(path.join(self.local_dir, name)))
+
+        # until the marker expires
+        cache.delete('%s_fetch' % storage.get_cache_key(name))
+        self.assertFalse(storage.fetch(name).get())
+
+    def test_transfer_compressed(self):
+        """
+        Make sure files are compressed when transferred and transparently
+        decompressed when opened
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            task='tests.tasks.GzipTransfer')
+
+        name = storage.save('data.csv', ContentFile(b'a,b\n1,2\n'))
+        os.remove(path.join(self.local_dir, name))
+        self.assertFalse(path.isfile(path.join(self.remote_dir, name)))
+        self.assertTrue(
+            path.isfile(path.join(self.remote_dir, name + '.gz')))
+
+        for i in range(2):
+            self.assertTrue(storage.using_remote(name))
+            self.assertTrue(storage.exists(name))
+            self.assertEqual(storage.url(name), name + '.gz')
+            with storage.open(name) as remote_file:
+                self.assertEqual(remote_file.read(), b'a,b\n1,2\n')
+            # found again without the cache
+            cache.clear()
+
+        # listed with the original names, and located in the meantime
+        storage.remote.save('archive.tar.gz', ContentFile(b'data'))
+        self.assertEqual(storage.listdir(''),
+                         ([], ['archive.tar.gz', 'data.csv']))
+        self.assertEqual(cache.get(storage.get_cache_key(name)), 'gzip')
+        self.assertEqual(
+            cache.get(storage.get_cache_key('archive.tar.gz')), True)
+        with storage.open(name) as remote_file:
+            self.assertEqual(remote_file.read(), b'a,b\n1,2\n')
+
+        # the compressed name got taken meanwhile
+        storage.local.save('taken.csv', ContentFile(b'a,b\n'))
+        storage.remote.save('taken.csv.gz', ContentFile(b'other'))
+        self.assertFalse(Transfer().transfer('taken.csv', storage.local,
+                                             storage.remote, 'gzip'))
+        self.assertEqual(
+            [entry for entry in os.listdir(self.remote_dir)
+             if entry.startswith('taken')], ['taken.csv.gz'])
+        with storage.remote.open('taken.csv.gz') as taken_file:
+            self.assertEqual(taken_file.read(), b'other')
+
+        # not compressed, wrong content type
+        name = storage.save('data.bin', ContentFile(b'data'))
+        self.assertTrue(path.isfile(path.join(self.remote_dir, name)))
+
+    def test_locate_uncompressed(self):
+        """
+        Make sure files are located with a single request each if files
+        aren't compressed, and compressed copies are looked for otherwise
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='tests.tasks.CountingStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir))
+        storage.remote.save('remote.txt', ContentFile(b'test'))
+        tasks.CountingStorage.exists_calls = []
+        self.addCleanup(setattr, tasks.CountingStorage, 'exists_calls', [])
+
+        self.assertTrue(storage.exists('remote.txt'))
+        self.assertFalse(storage.exists('missing.txt'))
+        # locating them, and checking the located remote file
+        self.assertEqual(tasks.CountingStorage.exists_calls,
+                         ['remote.txt', 'remote.txt', 'missing.txt'])
+
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='tests.tasks.CountingStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            task='tests.tasks.GzipTransfer')
+        tasks.CountingStorage.exists_calls = []
+        self.assertFalse(storage.exists('other.txt'))
+        self.assertEqual(tasks.CountingStorage.exists_calls[:2],
+                         ['other.txt', 'other.txt.gz'])
+
+    def test_compression_encodings(self):
+        """
+        Make sure all content encodings compress and decompress
+        """
+        for encoding, extension in ENCODINGS.items():
+            if encoding == 'zstd':
+                try:
+                    import zstandard  # noqa
+                except ImportError:
+                    continue
+            content = ContentFile(b'test' * 1000, name='test.txt')
+            compressed = compress(content, encoding)
+            self.assertEqual(compressed.name, 'test.txt' + extension)
+            self.assertLess(compressed.size, 1000)
+            self.assertEqual(decompress(compressed, encoding).read(),
+                             b'test' * 1000)
+
+    def test_transfer_multiple_remotes(self):
+        """
+        Make sure files are replicated to multiple remote storages, read from
+        the first one they exist in and only retried for the failed ones
+        """
+        other_remote_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_remote_dir)
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote=['django.core.files.storage.FileSystemStorage',
+                    'tests.tasks.FlakyStorage'],
+            local_options=dict(location=self.local_dir),
+            remote_options=[dict(location=self.remote_dir),
+                            dict(location=other_remote_dir)])
+        self.assertEqual(len(storage.remotes), 2)
+        self.addCleanup(setattr, tasks.FlakyStorage, 'failed', False)
+        tasks.FlakyStorage.failed = False
+
+        name = storage.save(self.test_file_name, File(self.test_file))
+        self.assertTrue(tasks.FlakyStorage.failed)
+        self.assertEqual(os.listdir(self.remote_dir), [name])
+        self.assertEqual(os.listdir(other_remote_dir), [name])
+        self.assertEqual(cache.get(storage.get_cache_key(name)), (True, True))
+
+        self.assertIs(storage.get_storage(name), storage.remotes[0])
+        os.remove(path.join(self.remote_dir, name))
+        cache.clear()
+        self.assertTrue(storage.using_remote(name))
+        self.assertIs(storage.get_storage(name), storage.remotes[1])
+        with storage.open(name) as remote_file:
+            self.assertEqual(remote_file.read(), b'test')
+
+    def test_sharded_local_storage(self):
+        """
+        Make sure the sharded storage spreads files across its locations
+        """
+        other_local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_local_dir)
+        locations = [self.local_dir, other_local_dir]
+        local = ShardedFileSystemStorage(locations=locations)
+        names = ['test/file_%d.txt' % i for i in range(20)]
+        for name in names:
+            local.save(name, ContentFile(b'test'))
+            location = local.get_location(name)
+            self.assertIn(location, locations)
+            self.assertTrue(path.isfile(path.join(location, name)))
+            self.assertEqual(local.size(name), 4)
+            # stable across instances
+            self.assertEqual(
+                ShardedFileSystemStorage(locations=locations).get_location(name),
+                location)
+        self.assertTrue(os.listdir(path.join(self.local_dir, 'test')))
+        self.assertTrue(os.listdir(path.join(other_local_dir, 'test')))
+        self.assertEqual(local.listdir('test'),
+                         ([], sorted(name[5:] for name in names)))
+        self.assertEqual(local.listdir(''), (['test'], []))
+        local.delete(names[0])
+        self.assertFalse(local.exists(names[0]))
+
+        storage = QueuedStorage(
+            local='queued_storage.storages.ShardedFileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(locations=locations),
+            remote_options=dict(location=self.remote_dir))
+        name = storage.save(self.test_file_name, File(self.test_file))
+        self.assertTrue(path.isfile(path.join(self.remote_dir, name)))
+        with storage.open(name) as remote_file:
+            self.assertEqual(remote_file.read(), b'test')
+
+    @skipIf(sys.version_info < (3, 5), "requires Python 3.5 or newer")
+    def test_async_api(self):
+        """
+        Make sure the async methods work
+        """
+        import asyncio
+
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            delayed=True)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        name = loop.run_until_complete(
+            storage.asave(self.test_file_name, File(self.test_file)))
+        self.assertIs(loop.run_until_complete(storage.aget_storage(name)),
+                      storage.local)
+        self.assertTrue(loop.run_until_complete(storage.aexists(name)))
+        self.assertEqual(loop.run_until_complete(storage.asize(name)), 4)
+
+        result = loop.run_until_complete(storage.atransfer(name))
+        self.assertTrue(result.get())
+        self.assertIs(loop.run_until_complete(storage.aget_storage(name)),
+                      storage.remote)
+        self.assertEqual(loop.run_until_complete(storage.aurl(name)), name)
+        remote_file = loop.run_until_complete(storage.aopen(name))
+        with remote_file:
+            self.assertEqual(remote_file.read(), b'test')
+
+        loop.run_until_complete(storage.adelete(name))
+        self.assertFalse(loop.run_until_complete(storage.aexists(name)))
+
+        # the size of the file, not of its compressed copy
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            task='tests.tasks.GzipTransfer')
+        name = loop.run_until_complete(
+            storage.asave('data.txt', ContentFile(b'test' * 500)))
+        self.assertTrue(path.isfile(path.join(self.remote_dir,
+                                              name + '.gz')))
+        self.assertEqual(storage.size(name), 2000)
+        self.assertEqual(loop.run_until_complete(storage.asize(name)), 2000)
+
     def test_transfer_returns_boolean(self):
         """
         Make sure an exception is thrown when the transfer task does not return
@@ -235,6 +1322,115 @@ class StorageTests(TestCase):
 
         self.assertTrue(models.TestModel.retried)
 
+    def test_transfer_lease(self):
+        """
+        Make sure a file isn't transferred by two workers at once
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            delayed=True)
+        name = storage.save(self.test_file_name, File(self.test_file))
+        cache_key = storage.get_cache_key(name)
+        lease_key = '%s_lease' % cache_key
+        self.assertTrue(cache.add(lease_key, 'other worker'))
+
+        contended = []
+
+        def other_worker_done(sender, name, **kwargs):
+            contended.append(name)
+            cache.set(cache_key, True)
+            cache.delete(lease_key)
+
+        transfer_contended.connect(other_worker_done)
+        self.addCleanup(transfer_contended.disconnect, other_worker_done)
+        storage.transfer(name)
+        self.assertEqual(contended, [name])
+        self.assertFalse(path.isfile(path.join(self.remote_dir, name)))
+        self.assertIsNone(cache.get(lease_key))
+
+        cache.set(cache_key, False)
+        self.assertTrue(storage.transfer(name).get())
+        self.assertEqual(contended, [name])
+        self.assertTrue(path.isfile(path.join(self.remote_dir, name)))
+
+    def test_transfer_lease_postponements(self):
+        """
+        Make sure postponing a transfer doesn't use up its retries
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            task='tests.tasks.SingleRetryTransfer', delayed=True)
+        name = storage.save(self.test_file_name, File(self.test_file))
+        lease_key = '%s_lease' % storage.get_cache_key(name)
+        self.assertTrue(cache.add(lease_key, 'other worker'))
+
+        contended = []
+
+        def other_worker_failed(sender, name, **kwargs):
+            contended.append(name)
+            if len(contended) == 3:
+                cache.delete(lease_key)
+
+        transfer_contended.connect(other_worker_failed)
+        self.addCleanup(transfer_contended.disconnect, other_worker_failed)
+        self.assertTrue(storage.transfer(name).get())
+        self.assertEqual(contended, [name] * 3)
+        self.assertTrue(storage.using_remote(name))
+
+    def test_lease_renewed(self):
+        """
+        Make sure leases are renewed while held and released afterwards
+        """
+        lease = Lease('test_lease', 30)
+        self.assertTrue(lease.acquire())
+        self.assertFalse(Lease('test_lease', 30).acquire())
+        lease.release()
+        self.assertIsNone(cache.get('test_lease'))
+
+        class Clock(object):
+            """
+            Stands in for the event the heartbeat waits on, a third of
+            the timeout passing with each wait until stopped.
+            """
+            def __init__(self, ticks):
+                self.ticks = ticks
+                self.waits = []
+
+            def wait(self, timeout):
+                self.waits.append(timeout)
+                return len(self.waits) > self.ticks
+
+        renewals = []
+        cache_set = cache.set
+
+        def record_set(key, value, timeout):
+            renewals.append((key, value, timeout))
+            cache_set(key, value, timeout)
+
+        cache.set = record_set
+        self.addCleanup(delattr, cache, 'set')
+        lease = Lease('test_lease', 30)
+        lease._stopped = Clock(2)
+        self.assertTrue(cache.add('test_lease', lease.token, 30))
+        lease._renew()
+        self.assertEqual(lease._stopped.waits, [10.0] * 3)
+        self.assertEqual(renewals, [('test_lease', lease.token, 30)] * 2)
+
+        # not renewed anymore once taken over by another process
+        renewals = []
+        cache_set('test_lease', 'other', 30)
+        lease._stopped = Clock(2)
+        lease._renew()
+        self.assertEqual(lease._stopped.waits, [10.0])
+        self.assertEqual(renewals, [])
+        self.assertEqual(cache.get('test_lease'), 'other')
+
     def test_delayed_storage(self):
         storage = QueuedStorage(
             local='django.core.files.storage.FileSystemStorage',
@@ -282,3 +1478,146 @@ class StorageTests(TestCase):
         self.assertTrue(result)
         self.assertTrue(path.isfile(path.join(self.remote_dir,
                                               obj.remote.name)))
+
+    def test_remote_file_field_location(self):
+        """
+        Make sure the location of transferred files is recorded in the
+        location field and used for their URLs
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir,
+                               base_url='/local/'),
+            remote_options=dict(location=self.remote_dir,
+                                base_url='/remote/'),
+            delayed=True)
+        field = models.TestModel._meta.get_field('remote')
+        field.storage = storage
+        obj = models.TestModel()
+        obj.remote.save(self.test_file_name, File(self.test_file))
+        self.assertIsNone(obj.remote_location)
+        self.assertIsNone(obj.remote.location)
+
+        obj.remote.transfer()
+        obj = models.TestModel.objects.get(pk=obj.pk)
+        self.assertEqual(obj.remote_location, 'identity')
+        self.assertTrue(obj.remote.location)
+
+        # the cache isn't consulted for the URL
+        os.remove(path.join(self.remote_dir, obj.remote.name))
+        cache.clear()
+        self.assertTrue(obj.remote.url.startswith('/remote/'))
+        self.assertTrue(storage.url(obj.remote.name).startswith('/local/'))
+
+        storage.delayed = False
+        obj.remote.save('other.txt', ContentFile(b'test'))
+        self.assertEqual(models.TestModel.objects.get(
+            pk=obj.pk).remote_location, 'identity')
+
+    def test_transfer_queued_files(self):
+        """
+        Make sure the files of a queryset are transferred in chunks,
+        skipping the already transferred ones
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            delayed=True)
+        field = models.TestModel._meta.get_field('remote')
+        field.storage = storage
+        objs = []
+        for index in range(3):
+            obj = models.TestModel()
+            obj.remote.save('file%s.txt' % index, ContentFile(b'test'))
+            objs.append(obj)
+        models.TestModel.objects.create()
+        objs[0].remote.transfer()
+
+        queued = transfer_queued_files(models.TestModel.objects.all(),
+                                       'remote', chunk_size=2)
+        self.assertEqual(queued, 2)
+        for obj in objs:
+            self.assertTrue(storage.using_remote(obj.remote.name))
+        self.assertEqual(transfer_queued_files(
+            models.TestModel.objects.all(), 'remote'), 0)
+
+
+class TransactionStorageTests(TransactionTestCase):
+
+    def setUp(self):
+        self.local_dir = tempfile.mkdtemp()
+        self.remote_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.local_dir)
+        self.addCleanup(shutil.rmtree, self.remote_dir)
+        self.addCleanup(cache.clear)
+
+    def test_storage_on_commit(self):
+        """
+        Make sure transfers are queued at once when the transaction is
+        committed, and dropped for rolled back transactions
+        """
+        storage = QueuedStorage(
+            local='django.core.files.storage.FileSystemStorage',
+            remote='django.core.files.storage.FileSystemStorage',
+            local_options=dict(location=self.local_dir),
+            remote_options=dict(location=self.remote_dir),
+            on_commit=True)
+        with transaction.atomic():
+            first = storage.save('first.txt', ContentFile(b'test'))
+            try:
+                with transaction.atomic():
+                    dropped = storage.save('dropped.txt',
+                                           ContentFile(b'test'))
+                    raise ValueError
+            except ValueError:
+                pass
+            second = storage.save('second.txt', ContentFile(b'test'))
+            self.assertIsNone(storage.result)
+            self.assertFalse(storage.using_remote(first))
+            # a single hook dispatching them
+            self.assertEqual(len(connection.run_on_commit), 1)
+
+        self.assertTrue(storage.using_remote(first))
+        self.assertTrue(storage.using_remote(second))
+        # the file was saved to the local storage anyway
+        self.assertTrue(storage.using_remote(dropped))
+
+        with transaction.atomic():
+            storage.save('rolled_back.txt', ContentFile(b'test'))
+            transaction.set_rollback(True)
+        self.assertFalse(
+            path.isfile(path.join(self.remote_dir, 'rolled_back.txt')))
+
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    dropped = storage.save('dropped.txt',
+                                           ContentFile(b'test'))
+                    raise ValueError
+            except ValueError:
+                pass
+            # the batch was rolled back with the first transfer, and
+            # isn't reused
+            third = storage.save('third.txt', ContentFile(b'test'))
+        self.assertFalse(storage.using_remote(dropped))
+        self.assertTrue(storage.using_remote(third))
+        self.assertFalse(storage.using_remote('rolled_back.txt'))
+
+        # small files aren't uploaded before the transaction is committed
+        storage.inline_max_size = 10
+        with transaction.atomic():
+            small = storage.save('small.txt', ContentFile(b'test'))
+            self.assertFalse(
+                path.isfile(path.join(self.remote_dir, small)))
+            transaction.set_rollback(True)
+        self.assertFalse(path.isfile(path.join(self.remote_dir, small)))
+        small = storage.save('small.txt', ContentFile(b'test'))
+        self.assertTrue(path.isfile(path.join(self.remote_dir, small)))
+        storage.inline_max_size = None
+
+        results = storage.transfer_many([dropped, 'rolled_back.txt'])
+        self.assertEqual([result.get() for result in results], [True, True])
+        self.assertTrue(storage.using_remote(dropped))